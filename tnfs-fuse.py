@@ -31,8 +31,129 @@ from time import time
 import stat
 import os
 import errno
+import functools
+import inspect
+import socket
+import threading
 
 import tnfs_client
+import tnfs_cache
+import tnfs_cached
+import tnfs_index
+import tnfs_profile
+
+def parseAddress(address):
+	if address.count(':') == 0:
+		address += ":16384"
+	host, port = address.split(':')
+	return host, int(port)
+
+## Virtual directory exposing the client's internals, it never reaches the server
+ControlDir = "/.tnfs"
+ControlFiles = {
+	"metrics": lambda: tnfs_client.metrics.format(),
+	"memory": lambda: MetaCache.memoryReport(),
+	"profile": lambda: Profiler.format(),
+}
+## Control files that can also be written to, with what the text written does
+ControlActions = {
+	"profile": lambda text: Profiler.command(text),
+}
+
+Profiler = tnfs_profile.SamplingProfiler()
+
+def controlFile(path):
+	if path.startswith(ControlDir + "/") and path[len(ControlDir) + 1:] in ControlFiles:
+		return path[len(ControlDir) + 1:]
+	return None
+
+## Looking up /.tnfs/find/<name or glob> lists symbolic links to the matches in the name index
+SearchDir = ControlDir + "/find"
+## A listing is followed by a getattr per entry, so results are kept for a few seconds
+SearchResults = {}
+
+def searchResults(pattern):
+	"""{entry name: link target} for a query directory. Entry names are the matches' names,
+	numbered when several share one"""
+	cached = SearchResults.get(pattern)
+	if cached is not None and cached[0] > time():
+		return cached[1]
+	results = {}
+	for path in Names.search(pattern):
+		name = os.path.basename(path)
+		number = 1
+		while name in results:
+			number += 1
+			name = "%s (%d)" % (os.path.basename(path), number)
+		results[name] = "../../.." + path
+	if len(SearchResults) > 16:
+		SearchResults.clear()
+	SearchResults[pattern] = (time() + 5, results)
+	return results
+
+def searchLink(path):
+	if os.path.dirname(os.path.dirname(path)) != SearchDir:
+		return None
+	return searchResults(os.path.basename(os.path.dirname(path))).get(os.path.basename(path))
+
+## Files that moved more than this many bytes are bulk transfers, and give way to browsing
+BulkThreshold = 8 << 20
+
+## Reads of the same range of the same file made at the same time share one set of requests
+Reads = tnfs_client.SingleFlight("reads")
+
+## Size of the blocks kept in the mount's own block cache, when there is one
+BlockSize = 16384
+
+def foreground():
+	"""Makes the prefetcher give way to what the user is doing"""
+	if Prefetch is not None:
+		Prefetch.touch()
+
+def answersErrno(method):
+	"""fuse-python only turns an IOError into an error for the kernel if it has an errno, which
+	timeouts, calls made while the session is being recovered and malformed replies don't.
+	Those become EIO"""
+	def unreachable(e, metric = "fuse.unreachable"):
+		tnfs_client.metrics.increment(metric)
+		return IOError(errno.EIO, "%s: %s" % (os.strerror(errno.EIO), e))
+
+	if inspect.isgeneratorfunction(method):
+		@functools.wraps(method)
+		def generator(*args, **kw):
+			results = method(*args, **kw)
+			try:
+				for result in results:
+					yield result
+			except socket.error, e:
+				if e.errno is not None:
+					raise
+				raise unreachable(e)
+			except tnfs_client.ProtocolError, e:
+				raise unreachable(e, "fuse.malformed")
+			finally:
+				results.close()
+		return generator
+
+	@functools.wraps(method)
+	def wrapper(*args, **kw):
+		try:
+			return method(*args, **kw)
+		except socket.error, e:
+			if e.errno is not None:
+				raise
+			raise unreachable(e)
+		except tnfs_client.ProtocolError, e:
+			raise unreachable(e, "fuse.malformed")
+	return wrapper
+
+def statCached(path):
+	foreground()
+	cached = MetaCache.getAttributes(path)
+	if cached is None:
+		cached = TnfsSession.Stat(path)
+		MetaCache.setAttributes(path, *cached)
+	return cached
 
 def getParts(path):
 	if path == '/':
@@ -41,34 +162,156 @@ def getParts(path):
 		return path.split('/')
 
 class TNFS(Fuse):
+	replicas = None
+	cache_daemon = None
+	hedge = None
+	read_size = None
+	write_size = None
+	max_window = 64
+	max_rate = None
+	attr_ttl = 1
+	dir_ttl = 1
+	negative_ttl = 1
+	poll_rate = None
+	crawl_interval = None
+	crawl_rate = 50
+	index = None
+	index_interval = 300
+	keep_cache = 1
+	attr_timeout = None
+	max_read = None
+	big_writes = 1
+	profile_interval = 0.005
+	prefetch = None
+	prefetch_rate = 256 << 10
+	prefetch_idle = 1
+	cache_size = None
+	profile_file = None
+	threads = 0
+
 	def __init__(self, *args, **kw):
 		Fuse.__init__(self, *args, **kw)
 		print 'Init complete.'
 
 	def main(self, *a, **kw):
 		self.file_class = TNFS_File
+		self.kernelOptions()
+		Profiler.interval = float(self.profile_interval)
+		if self.multithreaded:
+			## Signal handlers only run on the main thread, which stays in libfuse's loop when threaded
+			print "Threaded: SIGUSR2 doesn't reach the profiler, write start or stop to %s/profile instead" % ControlDir
+		else:
+			tnfs_profile.installSignal(Profiler, self.profile_file or "/tmp/tnfs-profile-%d.folded" % os.getpid())
 		return Fuse.main(self, *a, **kw)
 
-	def fsinit(self):
-		if self.address.count(':') == 0:
-			self.address += ":16384"
-		address, port = self.address.split(':')
-		port = int(port)
+	def kernelOptions(self):
+		"""Hands the kernel caching options on to libfuse. Attributes stay cached in the kernel
+		for attr_ttl unless attr_timeout says otherwise"""
+		timeout = self.attr_timeout if self.attr_timeout is not None else self.attr_ttl
+		self.fuse_args.add("attr_timeout", str(timeout))
+		self.fuse_args.add("entry_timeout", str(timeout))
+		if self.max_read:
+			self.fuse_args.add("max_read", str(int(self.max_read)))
+		if str(self.big_writes).lower() not in ("0", "no", "false"):
+			self.fuse_args.add("big_writes")
 
+	def fsinit(self):
 		global TnfsSession
 
-		TnfsSession = tnfs_client.Session((address, port))
+		options = {
+			"read_size": int(self.read_size) if self.read_size else None,
+			"write_size": int(self.write_size) if self.write_size else None,
+			"max_window": int(self.max_window),
+			"max_rate": float(self.max_rate) if self.max_rate else None,
+		}
+		if self.cache_daemon:
+			TnfsSession = tnfs_cached.CachedSession(parseAddress(self.address), self.cache_daemon)
+			print 'Using the cache daemon at %s' % self.cache_daemon
+		elif self.replicas:
+			replicas = [parseAddress(replica) for replica in self.replicas.split(',')]
+			TnfsSession = tnfs_client.ReplicaSet(parseAddress(self.address), replicas, **options)
+			print 'Striping reads across %d server(s)' % len(TnfsSession.servers)
+		else:
+			TnfsSession = tnfs_client.Session(parseAddress(self.address), **options)
+		print 'TNFS payload sizes: read %d, write %d' % (TnfsSession.read_size, TnfsSession.write_size)
+		if self.hedge and not self.cache_daemon:
+			fraction = float(self.hedge) / 100
+			if isinstance(TnfsSession, tnfs_client.ReplicaSet):
+				TnfsSession.EnableHedging(fraction)
+			else:
+				options.update(read_size = TnfsSession.read_size, write_size = TnfsSession.write_size)
+				TnfsSession.EnableHedging([tnfs_client.Session(parseAddress(self.address), **options)], fraction)
 		print 'TNFS Session started with id %d' % TnfsSession.session
+		global Changes
+		Changes = tnfs_client.MutationBatcher(TnfsSession, int(self.max_window))
+
+		global MetaCache, Detector, Cursors, KeepCache, Keeper
+		KeepCache = str(self.keep_cache).lower() not in ("0", "no", "false")
+		index_file = self.indexFile()
+		index = tnfs_cache.IndexKeeper.load(index_file) if index_file else None
+		MetaCache = tnfs_cache.MetadataCache(float(self.attr_ttl), float(self.dir_ttl), index, float(self.negative_ttl))
+		Keeper = None
+		if index_file:
+			Keeper = tnfs_cache.IndexKeeper(TnfsSession, MetaCache, index_file, float(self.index_interval)).start()
+			print 'Metadata index %s (%s)' % (index_file, "loaded" if index is not None else "new")
+		Cursors = tnfs_cache.DirectoryCursors(TnfsSession)
+		global Names, NameCrawler
+		Names = tnfs_index.NameIndex()
+		crawl_interval = float(self.crawl_interval) if self.crawl_interval else None
+		NameCrawler = tnfs_index.Crawler(TnfsSession, Names, tnfs_cache.cachePath(parseAddress(self.address), "names"), crawl_interval, float(self.crawl_rate)).start()
+		Detector = None
+		if self.poll_rate:
+			Detector = tnfs_cache.ChangeDetector(TnfsSession, MetaCache, float(self.poll_rate)).start()
+
+		## The cache daemon keeps file blocks itself, otherwise the mount needs a cache to prefetch into
+		global Blocks, Prefetch
+		Blocks = None
+		cache_size = int(self.cache_size) if self.cache_size is not None else (64 if self.prefetch else 0)
+		if cache_size > 0 and not self.cache_daemon:
+			Blocks = tnfs_cache.BlockCache(cache_size << 20)
+		Prefetch = None
+		if self.prefetch:
+			roots = [os.path.normpath("/" + root) for root in self.prefetch.split(",")]
+			Prefetch = tnfs_cache.Prefetcher(TnfsSession, MetaCache, roots, Blocks, BlockSize, float(self.prefetch_rate), float(self.prefetch_idle)).start()
+			print 'Prefetching %s at up to %d bytes/s' % (", ".join(roots), float(self.prefetch_rate))
 
+	def indexFile(self):
+		"""Where the metadata index of this server is kept, None if index=off"""
+		if self.index is not None:
+			return None if self.index.lower() in ("off", "none", "0") else self.index
+		return tnfs_cache.cachePath(parseAddress(self.address), "index")
 
+	def fsdestroy(self):
+		Profiler.stop()
+		if Prefetch is not None:
+			Prefetch.stop()
+		if Detector is not None:
+			Detector.stop()
+		if Keeper is not None:
+			Keeper.stop()
+		NameCrawler.stop()
+		Cursors.closeAll()
+
+	@answersErrno
 	def getattr(self, path):
 		print '*** getattr', path
 		st = fuse.Stat()
-		if path == "/":
+		if path == "/" or path == ControlDir or path == SearchDir or os.path.dirname(path) == SearchDir:
 			st.st_nlink = 2
 			st.st_mode = stat.S_IFDIR | 0755
+		elif os.path.dirname(os.path.dirname(path)) == SearchDir:
+			target = searchLink(path)
+			if target is None:
+				return -errno.ENOENT
+			st.st_nlink = 1
+			st.st_mode = stat.S_IFLNK | 0777
+			st.st_size = len(target)
+		elif controlFile(path):
+			st.st_nlink = 1
+			st.st_mode = stat.S_IFREG | (0644 if controlFile(path) in ControlActions else 0444)
+			st.st_size = len(ControlFiles[controlFile(path)]())
 		else:
-			reply, tnfs_st = TnfsSession.Stat(path)
+			reply, tnfs_st = statCached(path)
 			if reply != 0:
 				return -errno.ENOENT
 			st.st_nlink = 1
@@ -80,17 +323,84 @@ class TNFS(Fuse):
 
 		return st
 
+	@answersErrno
 	def readdir(self, path, offset):
-		for e in TnfsSession.ListDir(path):
-			yield fuse.Direntry(e)
+		if path == ControlDir:
+			for e in sorted(ControlFiles) + [os.path.basename(SearchDir)]:
+				yield fuse.Direntry(e)
+			return
+		if path == SearchDir:
+			return
+		if os.path.dirname(path) == SearchDir:
+			for e in sorted(searchResults(os.path.basename(path))):
+				yield fuse.Direntry(e)
+			return
+		if Detector is not None:
+			Detector.touch(path)
+		foreground()
+		names = MetaCache.getDirectory(path)
+		if names is not None:
+			for number in range(offset, len(names)):
+				yield fuse.Direntry(names[number], offset = number + 1)
+			return
 
-	def unlink(self, path):
-		reply = TnfsSession.Unlink(path)
+		## Entries go to the kernel as they arrive. When its buffer fills up the generator is
+		## dropped, and the cursor waits for the continuation call at the offset it asks for
+		cursor = Cursors.take(path, offset)
+		try:
+			while True:
+				name = cursor.next()
+				if name is None:
+					break
+				yield fuse.Direntry(name, offset = cursor.offset)
+			names, cursor.names = cursor.names, None
+		finally:
+			Cursors.put(cursor)
+		if names is not None:
+			MetaCache.setDirectory(path, names)
+			MetaCache.warm(TnfsSession, path, names)
+
+	def readlink(self, path):
+		target = searchLink(path)
+		if target is None:
+			return -errno.ENOENT
+		return target
+
+	def change(self, *operation):
+		"""Makes a change through the batcher, so concurrent ones share a pipelined batch"""
+		reply = Changes.call(*operation)
+		Reads.forget()
+		for path in operation[1:]:
+			## Also drops what is cached below a directory that moved, went away or was replaced
+			MetaCache.invalidate(path)
+			if Blocks is not None:
+				Blocks.invalidate(path)
+			Cursors.invalidate(os.path.dirname(path))
+			if operation[0] in ("rename", "rmdir"):
+				Cursors.invalidate(path, tree = True)
 		return -reply
 
+	@answersErrno
+	def unlink(self, path):
+		return self.change("unlink", path)
+
+	@answersErrno
 	def rename(self, oldpath, newpath):
-		reply = TnfsSession.Rename(oldpath, newpath)
-		return -reply
+		return self.change("rename", oldpath, newpath)
+
+	@answersErrno
+	def mkdir(self, path, mode):
+		return self.change("mkdir", path)
+
+	@answersErrno
+	def rmdir(self, path):
+		return self.change("rmdir", path)
+
+	def truncate(self, path, size):
+		## Only shells writing to a control file with > get here, nothing else is supported
+		if controlFile(path) in ControlActions:
+			return 0
+		return -errno.ENOSYS
 
 ## Freezes the mount point (tnfsd is not replying)
 #	def chmod(self, path, mode):
@@ -98,37 +408,154 @@ class TNFS(Fuse):
 #		return -reply
 
 class TNFS_File(object):
+	@answersErrno
 	def __init__(self, path, flags, *mode):
+		self.path = path
+		self.contents = None
+		if controlFile(path):
+			self.written = None
+			if flags & 0x03 != os.O_RDONLY:
+				if controlFile(path) not in ControlActions:
+					raise IOError(errno.EACCES, os.strerror(errno.EACCES))
+				self.written = []
+			self.contents = ControlFiles[controlFile(path)]()
+			self.direct_io = True
+			self.keep_cache = False
+			return
+
 		tnfs_flags = tnfs_client.flagsToTNFS(flags)
 		reply, fd = TnfsSession.Open(path, tnfs_flags, *mode)
+		if flags & (os.O_CREAT | os.O_TRUNC):
+			MetaCache.invalidate(path)
+			Reads.forget()
+			if Blocks is not None:
+				Blocks.invalidate(path)
+		if flags & os.O_CREAT:
+			Cursors.invalidate(os.path.dirname(path))
 		if reply != 0:
 			raise IOError(reply, os.strerror(reply))
 		self.fd = fd
+		self.transferred = 0
+		## With threads, calls on the same open file mustn't move its position between an LSeek and the Read or Write after it
+		self.lock = threading.Lock()
+		self.striped = isinstance(TnfsSession, (tnfs_client.ReplicaSet, tnfs_cached.CachedSession)) and flags & 0x03 == os.O_RDONLY
+		if self.striped:
+			TnfsSession.OpenStriped(path)
 
+		## Pages the kernel cached during earlier opens are kept if the file hasn't changed since.
+		## That takes the server's current attributes, not cached ones that may be attr_ttl old
 		self.direct_io = False
 		self.keep_cache = False
+		current = None
+		if KeepCache and not flags & (os.O_CREAT | os.O_TRUNC):
+			current = TnfsSession.Stat(path)
+			MetaCache.setAttributes(path, *current)
+			self.keep_cache = current[0] == 0 and MetaCache.sameVersion(path, current[1])
+
+		## Read-only opens read whole blocks through the mount's block cache, which belong to
+		## the size and modification time the file has now, so those aren't taken from the cache either
+		self.version = None
+		if Blocks is not None and not self.striped and flags & 0x03 == os.O_RDONLY:
+			if current is None:
+				current = TnfsSession.Stat(path)
+				MetaCache.setAttributes(path, *current)
+			reply, tnfs_st = current
+			if reply == 0:
+				self.version = (tnfs_st.size, tnfs_st.mtime)
 
 	def flush(self):
 		pass
 
+	@answersErrno
 	def release(self, path):
+		if self.contents is not None:
+			if self.written:
+				try:
+					ControlActions[controlFile(path)]("".join(self.written))
+				except ValueError:
+					return -errno.EINVAL
+			return 0
+		if self.striped:
+			TnfsSession.CloseStriped(self.path)
 		reply = TnfsSession.Close(self.fd)
 		return -reply
 
+	def scheduling(self, length):
+		foreground()
+		with self.lock:
+			self.transferred += length
+		priority = tnfs_client.tnfs_priority.BULK if self.transferred > BulkThreshold else tnfs_client.tnfs_priority.FOREGROUND
+		return tnfs_client.requestPriority(priority, self.path)
+
+	@answersErrno
 	def read(self, length, offset):
-		reply = TnfsSession.LSeek(self.fd, offset, os.SEEK_SET)
-		if reply != 0:
-			raise IOError(reply, "[LSeek]" + os.strerror(reply))
-		reply, data = TnfsSession.Read(self.fd, length)
+		if self.contents is not None:
+			return self.contents[offset:offset + length]
+		with self.scheduling(length):
+			return self._read(length, offset)
+
+	def _read(self, length, offset):
+		## Reads arrive in a single bytearray; fuse-python wants a str, which is the only other copy made
+		if self.striped:
+			reply, data = TnfsSession.ReadAt(self.path, offset, length)
+			if reply != 0:
+				raise IOError(reply, "[Read]" + os.strerror(reply))
+			return str(data)
+		if self.version is not None:
+			return self._cachedRead(length, offset)
+		return Reads.call((self.path, offset, length), self._readAt, length, offset)
+
+	def _cachedRead(self, length, offset):
+		end = min(offset + length, self.version[0])
+		pieces = []
+		position = offset
+		while position < end:
+			number = position // BlockSize
+			fetch = functools.partial(self._fetchBlock, number)
+			reply, block = Blocks.get((self.path, self.version, number), fetch)
+			piece = block[position - number * BlockSize:end - number * BlockSize]
+			if not piece:
+				break
+			pieces.append(piece)
+			position += len(piece)
+		return "".join(pieces)
+
+	def _fetchBlock(self, number):
+		return 0, self._readAt(BlockSize, number * BlockSize)
+
+	def _readAt(self, length, offset):
+		with self.lock:
+			reply = TnfsSession.LSeek(self.fd, offset, os.SEEK_SET)
+			if reply != 0:
+				raise IOError(reply, "[LSeek]" + os.strerror(reply))
+			reply, data = TnfsSession.Read(self.fd, length)
+		## Reads at or past the end of the file are answered with an EOF error
+		if reply == tnfs_client.TnfsEOF:
+			return ""
 		if reply != 0:
 			raise IOError(reply, "[Read]" + os.strerror(reply))
-		return data
+		return str(data)
 
+	@answersErrno
 	def write(self, buf, offset):
-		reply = TnfsSession.LSeek(self.fd, offset, os.SEEK_SET)
-		if reply != 0:
-			raise IOError(reply, os.strerror(reply))
-		reply, written = TnfsSession.Write(self.fd, buf)
+		if self.contents is not None:
+			if self.written is None:
+				raise IOError(errno.EACCES, os.strerror(errno.EACCES))
+			self.written.append(buf)
+			return len(buf)
+		with self.scheduling(len(buf)):
+			return self._write(buf, offset)
+
+	def _write(self, buf, offset):
+		with self.lock:
+			reply = TnfsSession.LSeek(self.fd, offset, os.SEEK_SET)
+			if reply != 0:
+				raise IOError(reply, os.strerror(reply))
+			reply, written = TnfsSession.Write(self.fd, buf)
+		MetaCache.invalidate(self.path)
+		Reads.forget()
+		if Blocks is not None:
+			Blocks.invalidate(self.path)
 		if reply != 0:
 			raise IOError(reply, os.strerror(reply))
 		return written
@@ -137,5 +564,32 @@ if __name__ == "__main__":
 	fs = TNFS()
 	fs.multithreaded = 0
 	fs.parser.add_option(mountopt = "address", help = "<Address>[:<Port>] of the TNFS server. Port defaults to 16384 if not specified")
+	fs.parser.add_option(mountopt = "read_size", help = "Bytes per TNFS Read message. Probed after mounting if not specified")
+	fs.parser.add_option(mountopt = "write_size", help = "Bytes per TNFS Write message. Defaults to the read size, falling back to 512 if the server refuses")
+	fs.parser.add_option(mountopt = "max_window", help = "Most pipelined requests waiting for a reply per session, 1 turns pipelining off (default 64)")
+	fs.parser.add_option(mountopt = "max_rate", help = "Most requests per second sent on each session. Unlimited by default")
+	fs.parser.add_option(mountopt = "hedge", help = "Duplicate Stat, ReadDir and block reads that take longer than this latency percentile (e.g. 95)")
+	fs.parser.add_option(mountopt = "attr_ttl", help = "Seconds to cache file attributes for (default 1)")
+	fs.parser.add_option(mountopt = "dir_ttl", help = "Seconds to cache directory listings for (default 1)")
+	fs.parser.add_option(mountopt = "negative_ttl", help = "Seconds to cache that a path doesn't exist for, at most attr_ttl (default 1)")
+	fs.parser.add_option(mountopt = "poll_rate", help = "Directories per second to re-scan for changes made on the server, so the TTLs can be long. Off by default")
+	fs.parser.add_option(mountopt = "index", help = "File to save the metadata cache to, so later mounts start warm. Defaults to a file per server under ~/.cache/tnfs-fuse, off turns it off")
+	fs.parser.add_option(mountopt = "index_interval", help = "Seconds between saves of the metadata index (default 300). It is also saved at unmount")
+	fs.parser.add_option(mountopt = "crawl_interval", help = "Seconds between crawls of the whole server for the name index behind /.tnfs/find. Off by default, a saved index is still used")
+	fs.parser.add_option(mountopt = "crawl_rate", help = "Most directories per second the crawler lists (default 50)")
+	fs.parser.add_option(mountopt = "keep_cache", help = "Keep the kernel's cached pages of files whose size and modification time didn't change since their last open, 0 turns it off (default 1)")
+	fs.parser.add_option(mountopt = "attr_timeout", help = "Seconds the kernel caches attributes and names for. Defaults to attr_ttl")
+	fs.parser.add_option(mountopt = "max_read", help = "Most bytes the kernel asks for in one read")
+	fs.parser.add_option(mountopt = "big_writes", help = "Let the kernel send writes larger than a page, 0 turns it off (default 1)")
+	fs.parser.add_option(mountopt = "profile_interval", help = "Seconds between samples of the profiler, which SIGUSR2 or writing start/stop to /.tnfs/profile switches on and off (default 0.005). With threads only the file does")
+	fs.parser.add_option(mountopt = "profile_file", help = "Where SIGUSR2 writes the collapsed stacks when it stops the profiler. Defaults to /tmp/tnfs-profile-<pid>.folded. Unused with threads")
+	fs.parser.add_option(mountopt = "prefetch", help = "Comma separated directories to crawl while the mount is idle, caching their metadata and file contents")
+	fs.parser.add_option(mountopt = "prefetch_rate", help = "Most bytes per second of file contents the prefetcher reads (default 262144)")
+	fs.parser.add_option(mountopt = "prefetch_idle", help = "Seconds without file system calls before the prefetcher carries on (default 1)")
+	fs.parser.add_option(mountopt = "cache_size", help = "Megabytes of file blocks the mount caches itself. Defaults to 64 with prefetch and 0 without. Ignored with cache_daemon")
+	fs.parser.add_option(mountopt = "cache_daemon", help = "Unix socket of a running tnfs_cached.py to share sessions and caches with. The daemon's own options apply")
+	fs.parser.add_option(mountopt = "replicas", help = "Comma separated <Address>[:<Port>] list of mirrors of the server. File reads are striped across them")
+	fs.parser.add_option(mountopt = "threads", help = "Serve file system calls from several threads, so concurrent changes such as parallel rm share pipelined batches, 0 turns it off (default 0)")
 	fs.parse(values = fs, errex = 1)
+	fs.multithreaded = str(fs.threads).lower() not in ("0", "no", "false")
 	fs.main()
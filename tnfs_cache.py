@@ -0,0 +1,988 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2012 Radu Cristescu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import sys
+import stat
+import time
+import mmap
+import array
+import Queue
+import struct
+import socket
+import threading
+import collections
+
+from tnfs_client import fullPath, metrics, tnfs_flag, DirectoryCursor, StatResponse, ProtocolError, SingleFlight, requestPriority, tnfs_priority
+
+def cachePath(address, extension):
+	"""A file kept between runs for a server, under ~/.cache/tnfs-fuse"""
+	directory = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "tnfs-fuse")
+	if not os.path.isdir(directory):
+		os.makedirs(directory, 0700)
+	return os.path.join(directory, "%s_%d.%s" % (address[0], address[1], extension))
+
+def isBelow(path, directories):
+	"""Whether path is one of directories or inside one of them"""
+	while path not in ("/", ""):
+		if path in directories:
+			return True
+		path = os.path.dirname(path)
+	return False
+
+class MetadataIndex(object):
+	"""A saved copy of a MetadataCache, mapped into memory so that opening it costs the same
+	whatever its size. Records are only read when looked up, by binary search over offset
+	tables sorted by path.
+
+	Layout: magic, attribute and directory counts, the two offset tables, then the records.
+	A record is the path and its data, each with a length in front. Attribute data is the Stat
+	reply as it came off the wire, directory data the names separated by NUL bytes."""
+	Magic = "TNFSIDX1"
+
+	def __init__(self, filename):
+		with open(filename, "rb") as f:
+			self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		if self.map[:len(self.Magic)] != self.Magic:
+			raise ProtocolError("Not a metadata index: %s" % filename)
+		self.attr_count, self.dir_count = struct.unpack_from("<II", self.map, len(self.Magic))
+		self.attr_table = len(self.Magic) + 8
+		self.dir_table = self.attr_table + 4 * self.attr_count
+		if len(self.map) < self.dir_table + 4 * self.dir_count:
+			raise ProtocolError("Truncated metadata index: %s" % filename)
+
+	def _record(self, table, number):
+		offset, = struct.unpack_from("<I", self.map, table + 4 * number)
+		length, = struct.unpack_from("<H", self.map, offset)
+		path = self.map[offset + 2:offset + 2 + length]
+		offset += 2 + length
+		length, = struct.unpack_from("<I", self.map, offset)
+		return path, self.map[offset + 4:offset + 4 + length]
+
+	def _find(self, table, count, path):
+		low, high = 0, count
+		while low < high:
+			middle = (low + high) // 2
+			found, data = self._record(table, middle)
+			if found == path:
+				return data
+			if found < path:
+				low = middle + 1
+			else:
+				high = middle
+		return None
+
+	def getAttributes(self, path):
+		data = self._find(self.attr_table, self.attr_count, path)
+		return StatResponse().fromWire(data) if data is not None else None
+
+	def getDirectory(self, path):
+		data = self._find(self.dir_table, self.dir_count, path)
+		if data is None:
+			return None
+		return data.split("\0") if len(data) > 0 else []
+
+	def attributeItems(self):
+		for number in range(self.attr_count):
+			path, data = self._record(self.attr_table, number)
+			yield path, StatResponse().fromWire(data)
+
+	def directoryItems(self):
+		for number in range(self.dir_count):
+			path, data = self._record(self.dir_table, number)
+			yield path, data.split("\0") if len(data) > 0 else []
+
+	@classmethod
+	def write(klass, filename, attributes, directories):
+		"""Saves {path: StatResponse} and {path: names} to filename, replacing it atomically"""
+		records = [sorted((path, attributes[path].toWire()) for path in attributes),
+			sorted((path, "\0".join(directories[path])) for path in directories)]
+		offset = len(klass.Magic) + 8 + 4 * (len(records[0]) + len(records[1]))
+		tables = []
+		for path, data in records[0] + records[1]:
+			tables.append(struct.pack("<I", offset))
+			offset += 6 + len(path) + len(data)
+
+		temporary = "%s.%d.tmp" % (filename, os.getpid())
+		with open(temporary, "wb") as f:
+			f.write(klass.Magic + struct.pack("<II", len(records[0]), len(records[1])))
+			f.write("".join(tables))
+			for path, data in records[0] + records[1]:
+				f.write(struct.pack("<H", len(path)) + path + struct.pack("<I", len(data)) + data)
+		os.rename(temporary, filename)
+
+class PathTable(object):
+	"""Numbers paths. A path is kept as the id of its parent and its last component, and the
+	components are interned, so the names a million paths share are stored once"""
+	def __init__(self):
+		self.parents = array.array("i", [-1])
+		self.names = [""]
+		## {directory id: {name: id}}, for directories that have had children numbered
+		self.children = {}
+
+	def __len__(self):
+		return len(self.parents)
+
+	def id(self, path, create = True):
+		"""The id of a path, numbering it if it is new and create is set, or None"""
+		number = 0
+		for name in path.split("/"):
+			if not name:
+				continue
+			children = self.children.get(number)
+			child = children.get(name) if children is not None else None
+			if child is None:
+				if not create:
+					return None
+				if children is None:
+					children = self.children[number] = {}
+				child = children[intern(name)] = len(self.parents)
+				self.parents.append(number)
+				self.names.append(intern(name))
+			number = child
+		return number
+
+	def descendants(self, number):
+		"""Ids of every path numbered below a directory"""
+		pending = [number]
+		while len(pending) > 0:
+			children = self.children.get(pending.pop())
+			if children is not None:
+				for child in children.itervalues():
+					yield child
+					pending.append(child)
+
+	def path(self, number):
+		names = []
+		while number > 0:
+			names.append(self.names[number])
+			number = self.parents[number]
+		return "/" + "/".join(reversed(names))
+
+class MetadataStore(object):
+	"""Stat results kept in typed arrays indexed by path id, one column per field, and
+	directory listings kept as tuples of interned names. Not thread safe, MetadataCache holds
+	its lock around every call"""
+	## Bits of the flags column
+	Cached = 1
+	AttrConsulted = 2
+	DirConsulted = 4
+
+	Columns = (("expiry", "d"), ("reply", "B"), ("flags", "B"), ("mode", "H"), ("uid", "H"), ("gid", "H"),
+		("size", "I"), ("atime", "I"), ("mtime", "I"), ("ctime", "I"), ("user", "H"), ("group", "H"))
+
+	def __init__(self):
+		self.paths = PathTable()
+		for name, code in self.Columns:
+			setattr(self, name, array.array(code, [0]))
+		self.owners = ["anonymous"]
+		self.owner_ids = {"anonymous": 0}
+		## {path id: (expiry, names)}
+		self.directories = {}
+
+	def id(self, path, create = True):
+		number = self.paths.id(path, create)
+		while len(self.flags) < len(self.paths):
+			for name, _ in self.Columns:
+				getattr(self, name).append(0)
+		return number
+
+	def _owner(self, name):
+		number = self.owner_ids.get(name)
+		if number is None:
+			number = self.owner_ids[intern(name)] = len(self.owners)
+			self.owners.append(intern(name))
+		return number
+
+	def setAttributes(self, number, expiry, reply, attributes):
+		self.expiry[number] = expiry
+		self.reply[number] = reply
+		self.flags[number] |= self.Cached
+		if reply != 0:
+			return
+		for name in ("mode", "uid", "gid", "size", "atime", "mtime", "ctime"):
+			getattr(self, name)[number] = getattr(attributes, name) or 0
+		self.user[number] = self._owner(attributes.user)
+		self.group[number] = self._owner(attributes.group)
+
+	def getAttributes(self, number):
+		"""(expiry, reply, StatResponse) of a path id, or None"""
+		if not self.flags[number] & self.Cached:
+			return None
+		attributes = StatResponse().setSession(0).setReply(self.reply[number])
+		if self.reply[number] == 0:
+			attributes.setMode(self.mode[number]).setUID(self.uid[number]).setGID(self.gid[number]).setSize(self.size[number])
+			attributes.setAtime(self.atime[number]).setMtime(self.mtime[number]).setCtime(self.ctime[number])
+			attributes.setUser(self.owners[self.user[number]]).setGroup(self.owners[self.group[number]])
+		return self.expiry[number], self.reply[number], attributes
+
+	def dropAttributes(self, number):
+		self.flags[number] &= ~self.Cached
+
+	def attributeIds(self):
+		return [number for number in xrange(len(self.flags)) if self.flags[number] & self.Cached]
+
+	def setDirectory(self, number, expiry, names):
+		self.directories[number] = (expiry, tuple(intern(name) for name in names))
+
+	def getDirectory(self, number):
+		return self.directories.get(number)
+
+	def isConsulted(self, number, bit):
+		return self.flags[number] & bit != 0
+
+	def consult(self, number, bit):
+		self.flags[number] |= bit
+
+	def copy(self):
+		"""A snapshot to save from without holding the lock. Its ids can be turned back into
+		paths, but paths can't be looked up in it"""
+		copy = MetadataStore.__new__(MetadataStore)
+		copy.paths = PathTable.__new__(PathTable)
+		copy.paths.parents = array.array("i", self.paths.parents)
+		copy.paths.names = list(self.paths.names)
+		copy.paths.children = {}
+		for name, code in self.Columns:
+			setattr(copy, name, array.array(code, getattr(self, name)))
+		copy.owners = list(self.owners)
+		copy.owner_ids = self.owner_ids
+		copy.directories = dict(self.directories)
+		return copy
+
+	def compacted(self, now):
+		"""A copy holding only the paths with something worth keeping: attributes or a listing
+		that hasn't expired, or the bits stopping an index entry being loaded again, and the
+		directories above them. Ids change, owners are shared"""
+		consulted = self.AttrConsulted | self.DirConsulted
+		keep = [number for number in xrange(1, len(self.flags))
+			if self.flags[number] & consulted or (self.flags[number] & self.Cached and self.expiry[number] >= now)]
+		keep += [number for number, entry in self.directories.iteritems() if entry[0] >= now]
+		store = MetadataStore()
+		store.owners = self.owners
+		store.owner_ids = self.owner_ids
+		for number in sorted(set(keep)):
+			new = store.id(self.paths.path(number))
+			for name, _ in self.Columns:
+				getattr(store, name)[new] = getattr(self, name)[number]
+			if number in self.directories:
+				store.directories[new] = self.directories[number]
+		return store
+
+	def memoryUse(self):
+		"""Approximate bytes taken, by part"""
+		tables = self.paths.children.values()
+		unique = dict((id(name), name) for name in self.paths.names)
+		return {
+			"columns": sum(sys.getsizeof(getattr(self, name)) for name, _ in self.Columns),
+			"paths": sys.getsizeof(self.paths.parents) + sys.getsizeof(self.paths.names) + sys.getsizeof(self.paths.children)
+				+ sum(sys.getsizeof(table) for table in tables) + 24 * max(0, len(self.paths) - 257),
+			"names": sum(sys.getsizeof(name) for name in unique.values()),
+			"listings": sys.getsizeof(self.directories) + sum(sys.getsizeof(entry) + sys.getsizeof(entry[1]) for entry in self.directories.values()),
+		}
+
+class MetadataCache(object):
+	"""Stat results and directory listings of remote paths, each kept for its time to live.
+	Replies saying a path doesn't exist are kept for negative_ttl at most, as it is likely to
+	be created soon after being looked for.
+
+	With an index, entries not in memory yet are taken from it on first use. They are served
+	straight away and queued on stale for a revalidation, see IndexKeeper.
+
+	Looking a path up doesn't number it, only caching something for it does. Paths whose
+	entries have expired are dropped whenever the number of paths has doubled, see expire."""
+	## Fewest paths to have before dropping expired ones
+	CompactSize = 4096
+
+	def __init__(self, attr_ttl = 1.0, dir_ttl = 1.0, index = None, negative_ttl = 1.0):
+		self.lock = threading.Lock()
+		self.attr_ttl = attr_ttl
+		self.dir_ttl = dir_ttl
+		self.negative_ttl = min(attr_ttl, negative_ttl)
+		self.store = MetadataStore()
+		self.versions = {}
+		self.index = index
+		self.stale = Queue.Queue()
+		## Directories renamed or removed since the index was written, whose indexed contents are gone
+		self.dropped = set()
+		self.compact_at = self.CompactSize
+		## Bumped whenever the store is compacted and its ids change
+		self.compactions = 0
+
+	def _indexed(self, kind, path, number):
+		"""Moves an entry from the index into memory, already expired so it is only served once
+		before the revalidation. Entries already loaded or invalidated aren't taken again.
+		number is None for paths not numbered yet. Called with the lock held"""
+		bit = MetadataStore.AttrConsulted if kind == "attr" else MetadataStore.DirConsulted
+		if self.index is None or (number is not None and self.store.isConsulted(number, bit)):
+			return None
+		value = None
+		if len(self.dropped) == 0 or not isBelow(path, self.dropped):
+			value = self.index.getAttributes(path) if kind == "attr" else self.index.getDirectory(path)
+		if value is None:
+			if number is not None:
+				self.store.consult(number, bit)
+			return None
+		if number is None:
+			number = self.store.id(path)
+		self.store.consult(number, bit)
+		if kind == "attr":
+			self.store.setAttributes(number, 0, value.reply, value)
+			entry = (0, value.reply, value)
+		else:
+			self.store.setDirectory(number, 0, value)
+			entry = (0, value)
+		self.stale.put((kind, path))
+		metrics.increment("cache.index_hits")
+		return entry
+
+	def _grown(self):
+		"""Drops expired paths if there are twice as many as the last time. Called with the
+		lock held, before taking any ids"""
+		if len(self.store.paths) >= self.compact_at:
+			self._compact()
+
+	def _compact(self):
+		self.store = self.store.compacted(time.time())
+		self.compact_at = max(self.CompactSize, 2 * len(self.store.paths))
+		self.compactions += 1
+		metrics.increment("cache.compactions")
+
+	def expire(self):
+		"""Drops the paths whose entries have all expired"""
+		with self.lock:
+			self._compact()
+
+	def getAttributes(self, path):
+		with self.lock:
+			self._grown()
+			number = self.store.id(path, create = False)
+			entry = self.store.getAttributes(number) if number is not None else None
+			if entry is None:
+				entry = self._indexed("attr", path, number)
+				if entry is not None:
+					return entry[1], entry[2]
+			if entry is None or entry[0] < time.time():
+				metrics.increment("cache.attr_misses")
+				return None
+		metrics.increment("cache.attr_hits")
+		return entry[1], entry[2]
+
+	def setAttributes(self, path, reply, attributes):
+		with self.lock:
+			self._grown()
+			ttl = self.attr_ttl if reply == 0 else self.negative_ttl
+			self.store.setAttributes(self.store.id(path), time.time() + ttl, reply, attributes)
+
+	def getDirectory(self, path):
+		with self.lock:
+			self._grown()
+			number = self.store.id(path, create = False)
+			entry = self.store.getDirectory(number) if number is not None else None
+			if entry is None:
+				entry = self._indexed("dir", path, number)
+				if entry is not None:
+					return list(entry[1])
+			if entry is None or entry[0] < time.time():
+				metrics.increment("cache.dir_misses")
+				return None
+		metrics.increment("cache.dir_hits")
+		return list(entry[1])
+
+	def setDirectory(self, path, names):
+		with self.lock:
+			self._grown()
+			self.store.setDirectory(self.store.id(path), time.time() + self.dir_ttl, names)
+
+	def peekAttributes(self, path):
+		"""Cached attributes regardless of their age, or None"""
+		with self.lock:
+			number = self.store.id(path, create = False)
+			entry = self.store.getAttributes(number) if number is not None else None
+		return entry[2] if entry is not None and entry[1] == 0 else None
+
+	def peekDirectory(self, path):
+		with self.lock:
+			number = self.store.id(path, create = False)
+			entry = self.store.getDirectory(number) if number is not None else None
+		return list(entry[1]) if entry is not None else None
+
+	def warm(self, session, directory, names):
+		"""Fetches the attributes of a whole directory with pipelined Stats, ahead of the
+		getattr calls that usually follow a readdir"""
+		for path, reply, attributes in session.StatMany([fullPath(directory, name) for name in names]):
+			self.setAttributes(path, reply, attributes)
+
+	def sameVersion(self, path, attributes):
+		"""Records the size and modification time of a file being opened, and returns whether
+		they are the ones seen at its previous open, so the kernel's cached pages are still good"""
+		version = (attributes.size, attributes.mtime)
+		with self.lock:
+			previous = self.versions.get(path)
+			self.versions[path] = version
+		same = previous == version
+		metrics.increment("cache.pages_kept" if same else "cache.pages_dropped")
+		return same
+
+	def invalidate(self, path):
+		"""Forgets a path, everything cached below it, for a directory that was renamed or
+		removed, and the listing of the directory containing it"""
+		directory = os.path.dirname(path)
+		with self.lock:
+			self._grown()
+			self.versions.pop(path, None)
+			## Paths the index knows need numbering so they can be marked as not to be loaded
+			indexed = self.index is not None and (self.index.getAttributes(path) is not None or self.index.getDirectory(path) is not None)
+			number = self.store.id(path) if indexed else self.store.id(path, create = False)
+			if self.index is not None and self.index.getDirectory(directory) is not None:
+				parent = self.store.id(directory)
+			else:
+				parent = self.store.id(directory, create = False)
+			numbers = [number] + list(self.store.paths.descendants(number)) if number is not None else []
+			for each in numbers:
+				self.store.dropAttributes(each)
+				self.store.directories.pop(each, None)
+			if parent is not None:
+				self.store.directories.pop(parent, None)
+			if len(numbers) > 1:
+				prefix = path.rstrip("/") + "/"
+				for other in [other for other in self.versions if other.startswith(prefix)]:
+					del self.versions[other]
+			if self.index is not None:
+				for each in numbers:
+					self.store.consult(each, MetadataStore.AttrConsulted | MetadataStore.DirConsulted)
+				if parent is not None:
+					self.store.consult(parent, MetadataStore.DirConsulted)
+				## The index may know paths below it that were never looked up
+				if path != "/" and (len(numbers) > 1 or self.index.getDirectory(path) is not None):
+					self.dropped.add(path)
+		metrics.increment("cache.invalidations")
+
+	def _forget(self, path, bits):
+		"""Drops the attributes (AttrConsulted) and or listing (DirConsulted) of one path and
+		nothing else. Called with the lock held"""
+		if self.index is not None:
+			indexed = (bits & MetadataStore.AttrConsulted and self.index.getAttributes(path) is not None) or (bits & MetadataStore.DirConsulted and self.index.getDirectory(path) is not None)
+		else:
+			indexed = False
+		## Paths the index knows need numbering so they can be marked as not to be loaded
+		number = self.store.id(path) if indexed else self.store.id(path, create = False)
+		if number is None:
+			return
+		if bits & MetadataStore.AttrConsulted:
+			self.store.dropAttributes(number)
+		if bits & MetadataStore.DirConsulted:
+			self.store.directories.pop(number, None)
+		if self.index is not None:
+			self.store.consult(number, bits)
+
+	def invalidateAttributes(self, path):
+		"""Forgets the attributes of a path that changed in place"""
+		with self.lock:
+			self._grown()
+			self.versions.pop(path, None)
+			self._forget(path, MetadataStore.AttrConsulted)
+		metrics.increment("cache.invalidations")
+
+	def invalidateListing(self, path):
+		"""Forgets the listing of a directory, but not the attributes of what is in it"""
+		with self.lock:
+			self._grown()
+			self._forget(path, MetadataStore.DirConsulted)
+		metrics.increment("cache.invalidations")
+
+	def save(self, filename):
+		"""Writes what is cached, plus whatever the index has that wasn't used or invalidated,
+		to a new index and switches to it"""
+		with self.lock:
+			store = self.store
+			copy = store.copy()
+			index = self.index
+			dropped = set(self.dropped)
+			compactions = self.compactions
+		attributes = {}
+		for number in copy.attributeIds():
+			entry = copy.getAttributes(number)
+			if entry[1] == 0:
+				attributes[copy.paths.path(number)] = entry[2]
+		directories = dict((copy.paths.path(number), entry[1]) for number, entry in copy.directories.items())
+		consulted = copy.flags
+		if index is not None:
+			for kind, items, bit in (("attr", index.attributeItems(), MetadataStore.AttrConsulted), ("dir", index.directoryItems(), MetadataStore.DirConsulted)):
+				saved = attributes if kind == "attr" else directories
+				for path, value in items:
+					if path in saved or (len(dropped) > 0 and isBelow(path, dropped)):
+						continue
+					with self.lock:
+						number = store.id(path, create = False)
+					if number is None or number >= len(consulted) or not consulted[number] & bit:
+						saved[path] = value
+		MetadataIndex.write(filename, attributes, directories)
+		index = MetadataIndex(filename)
+		## What was consulted is in the new index now, or deliberately left out of it
+		done = MetadataStore.AttrConsulted | MetadataStore.DirConsulted
+		numbers = [number for number in xrange(len(consulted)) if consulted[number] & done]
+		with self.lock:
+			self.index = index
+			self.dropped -= dropped
+			## After a compaction the ids differ, and the entries are left marked to be fetched afresh
+			if self.compactions == compactions:
+				for number in numbers:
+					store.flags[number] &= ~(consulted[number] & done)
+		metrics.set("cache.index_entries", len(attributes) + len(directories))
+
+	def memoryReport(self):
+		"""Text for /.tnfs/memory: how many paths are known and the bytes each part takes"""
+		with self.lock:
+			use = self.store.memoryUse()
+			paths = len(self.store.paths)
+			listings = len(self.store.directories)
+		metrics.set("cache.memory_bytes", sum(use.values()))
+		lines = ["paths %d" % paths, "listings %d" % listings]
+		lines += ["%s_bytes %d" % item for item in sorted(use.items())]
+		lines.append("total_bytes %d" % sum(use.values()))
+		return "".join(line + "\n" for line in lines)
+
+class BlockCache(object):
+	"""File blocks kept in least recently used order, up to capacity bytes. Keys start with the
+	path so a file's blocks can be dropped together. When several threads miss on the same
+	block, only the first one fetches it and the others wait for its result"""
+	def __init__(self, capacity = 64 << 20):
+		self.lock = threading.Lock()
+		self.capacity = capacity
+		self.size = 0
+		self.blocks = collections.OrderedDict()
+		self.paths = {}
+		self.flights = SingleFlight("blocks")
+		## Bumped by every invalidation, so blocks fetched from before one aren't stored after it
+		self.invalidations = 0
+
+	def get(self, key, fetch):
+		"""Returns (reply, data) for a block, calling fetch() for it on a miss"""
+		with self.lock:
+			data = self.blocks.pop(key, None)
+			if data is not None:
+				self.blocks[key] = data
+				metrics.increment("blocks.hits")
+				return 0, data
+		return self.flights.call(key, self._fetch, key, fetch)
+
+	def _fetch(self, key, fetch):
+		metrics.increment("blocks.misses")
+		invalidations = self.invalidations
+		result = fetch()
+		if result[0] == 0:
+			self._store(key, result[1], invalidations)
+		return result
+
+	def _store(self, key, data, invalidations):
+		with self.lock:
+			if key in self.blocks or invalidations != self.invalidations:
+				return
+			self.blocks[key] = data
+			self.paths.setdefault(key[0], set()).add(key)
+			self.size += len(data)
+			while self.size > self.capacity:
+				old, old_data = self.blocks.popitem(last = False)
+				self._unindex(old)
+				self.size -= len(old_data)
+				metrics.increment("blocks.evictions")
+			metrics.set("blocks.bytes", self.size)
+
+	def _unindex(self, key):
+		keys = self.paths.get(key[0])
+		if keys is not None:
+			keys.discard(key)
+			if len(keys) == 0:
+				del self.paths[key[0]]
+
+	def contains(self, key):
+		with self.lock:
+			return key in self.blocks
+
+	def invalidate(self, path):
+		"""Drops a file's blocks. Called once it has changed"""
+		self.flights.forget()
+		with self.lock:
+			self.invalidations += 1
+			for key in self.paths.pop(path, ()):
+				self.size -= len(self.blocks.pop(key))
+			metrics.set("blocks.bytes", self.size)
+
+class DirectoryCursors(object):
+	"""Directory cursors left open between the calls of a long listing, so a continuation
+	picks up where the previous call stopped instead of reading the directory again. Cursors
+	idle for longer than timeout are closed, and so are the oldest ones above limit."""
+	def __init__(self, session, timeout = 30.0, limit = 64):
+		self.session = session
+		self.timeout = timeout
+		self.limit = limit
+		self.lock = threading.Lock()
+		self.cursors = []
+		self.marks = {}
+
+	def take(self, path, offset):
+		"""An open cursor positioned at an entry number, reusing an idle one if possible"""
+		with self.lock:
+			expired = self._expire()
+			for cursor in self.cursors:
+				if cursor.path == path and (cursor.offset == offset or (cursor.offset - 1 == offset and cursor.last is not None)):
+					self.cursors.remove(cursor)
+					metrics.increment("cursors.hits")
+					break
+			else:
+				cursor = DirectoryCursor(self.session, path, self.marks.setdefault(path, {}))
+				metrics.increment("cursors.misses")
+		for old in expired:
+			old.close()
+		cursor.seek(offset)
+		return cursor
+
+	def put(self, cursor):
+		"""Hands a cursor back once a call is done with it. At the end of the directory its handle
+		is closed, but the cursor is kept to answer the kernel's last call without a round trip"""
+		if cursor.finished:
+			cursor.close()
+		with self.lock:
+			self.cursors.append(cursor)
+			expired = self._expire()
+		for old in expired:
+			old.close()
+
+	def _expire(self):
+		limit = time.time() - self.timeout
+		expired = [cursor for cursor in self.cursors if cursor.used < limit]
+		expired += [cursor for cursor in self.cursors if cursor not in expired][:max(0, len(self.cursors) - len(expired) - self.limit)]
+		for cursor in expired:
+			self.cursors.remove(cursor)
+		metrics.set("cursors.open", len(self.cursors))
+		return expired
+
+	def invalidate(self, path, tree = False):
+		"""Forgets the cursors and server positions of a directory whose entries changed, and
+		with tree, those of the directories below it as well"""
+		with self.lock:
+			if tree:
+				matches = lambda other: isBelow(other, (path,))
+			else:
+				matches = lambda other: other == path
+			dropped = [cursor for cursor in self.cursors if matches(cursor.path)]
+			for cursor in dropped:
+				self.cursors.remove(cursor)
+			for other in [other for other in self.marks if matches(other)]:
+				del self.marks[other]
+		for cursor in dropped:
+			cursor.close()
+
+	def closeAll(self):
+		with self.lock:
+			dropped, self.cursors = self.cursors, []
+		for cursor in dropped:
+			cursor.close()
+
+class IndexKeeper(object):
+	"""Background thread that revalidates entries served from the saved index, and saves the
+	cache to the index file every interval seconds and when stopped"""
+	def __init__(self, session, cache, filename, interval = 300):
+		self.session = session
+		self.cache = cache
+		self.filename = filename
+		self.interval = interval
+		self.stopped = threading.Event()
+		self.thread = None
+
+	@staticmethod
+	def load(filename):
+		"""The index saved in filename, or None if there isn't a usable one"""
+		try:
+			return MetadataIndex(filename)
+		except (IOError, ValueError, struct.error, mmap.error):
+			return None
+
+	def start(self):
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		self.save()
+
+	def save(self):
+		directory = os.path.dirname(self.filename)
+		try:
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory, 0700)
+			self.cache.save(self.filename)
+			metrics.increment("cache.index_saves")
+		except (IOError, OSError):
+			metrics.increment("cache.index_errors")
+
+	def revalidate(self, kind, path):
+		if kind == "attr":
+			self.cache.setAttributes(path, *self.session.Stat(path))
+		else:
+			self.cache.setDirectory(path, self.session.ListDir(path))
+		metrics.increment("cache.revalidations")
+
+	def run(self):
+		saved = time.time()
+		while not self.stopped.is_set():
+			try:
+				kind, path = self.cache.stale.get(timeout = 0.5)
+				with requestPriority(tnfs_priority.BULK, "revalidation"):
+					self.revalidate(kind, path)
+			except Queue.Empty:
+				pass
+			except (socket.error, IOError):
+				metrics.increment("cache.revalidation_errors")
+			if time.time() - saved >= self.interval:
+				self.save()
+				saved = time.time()
+
+class ChangeDetector(object):
+	"""Background poller that re-lists recently used directories and invalidates only the
+	cache entries whose name, size or modification time changed on the server.
+
+	Directories stay hot for hot_period seconds after their last readdir, and at most rate
+	directories are walked per second."""
+	def __init__(self, session, cache, rate = 1.0, hot_period = 600):
+		self.session = session
+		self.cache = cache
+		self.rate = rate
+		self.hot_period = hot_period
+		self.lock = threading.Lock()
+		self.hot = {}
+		self.snapshots = {}
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def touch(self, path):
+		with self.lock:
+			self.hot[path] = time.time()
+
+	def start(self):
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+
+	def hotDirectories(self):
+		with self.lock:
+			limit = time.time() - self.hot_period
+			for path, used in self.hot.items():
+				if used < limit:
+					del self.hot[path]
+					self.snapshots.pop(path, None)
+			return sorted(self.hot)
+
+	def run(self):
+		while not self.stopped.is_set():
+			directories = self.hotDirectories()
+			if len(directories) == 0:
+				self.stopped.wait(1.0 / self.rate)
+			for path in directories:
+				if self.stopped.is_set():
+					break
+				try:
+					with requestPriority(tnfs_priority.BULK, "detector"):
+						self.scan(path)
+				except (socket.error, IOError), e:
+					metrics.increment("detector.errors")
+				self.stopped.wait(1.0 / self.rate)
+
+	def snapshot(self, path):
+		entries = {}
+		for child, reply, attributes in self.session.StatMany([fullPath(path, filename) for filename in self.session.ListDir(path)]):
+			if reply == 0:
+				entries[os.path.basename(child)] = (attributes.mode, attributes.size, attributes.mtime)
+		return entries
+
+	def scan(self, path):
+		"""Compares a fresh listing with what the cache holds, falling back to the previous scan
+		for entries the cache has already dropped"""
+		current = self.snapshot(path)
+		with self.lock:
+			previous = self.snapshots.get(path, {})
+			self.snapshots[path] = current
+		metrics.increment("detector.scans")
+
+		listing = self.cache.peekDirectory(path)
+		known = set(listing) if listing is not None else set(previous)
+		changed = []
+		earlier = {}
+		for name in known | set(current):
+			cached = self.cache.peekAttributes(fullPath(path, name))
+			before = earlier[name] = (cached.mode, cached.size, cached.mtime) if cached is not None else previous.get(name)
+			if (before is not None or name not in known) and before != current.get(name):
+				changed.append(name)
+		for name in changed:
+			child = fullPath(path, name)
+			before, after = earlier[name], current.get(name)
+			if before is not None and after is not None and stat.S_IFMT(before[0]) == stat.S_IFMT(after[0]):
+				## Changed in place: what is below a directory is scanned on its own if it is hot
+				self.cache.invalidateAttributes(child)
+				if stat.S_ISDIR(after[0]):
+					self.cache.invalidateListing(child)
+			else:
+				## Created, removed or replaced, along with anything cached below it
+				self.cache.invalidate(child)
+		if known != set(current):
+			self.cache.invalidateListing(path)
+		metrics.increment("detector.changes", len(changed))
+		return changed
+
+class Prefetcher(object):
+	"""Background thread that walks the given directory trees once, while the mount is idle,
+	filling the metadata cache and reading every file into the block cache.
+
+	File data costs at most rate bytes per second, and everything stops for idle seconds after
+	each touch() from foreground activity. Blocks are stored under (path, (size, mtime), number)
+	as block_size pieces. Without a block cache, files are read with ReadAt, for a session whose
+	reads already go through a cache (the cache daemon's). Progress is in the prefetch.* metrics"""
+	def __init__(self, session, cache, roots, blocks = None, block_size = 16384, rate = 256 << 10, idle = 1.0):
+		self.session = session
+		self.cache = cache
+		self.roots = roots
+		self.blocks = blocks
+		self.block_size = block_size
+		self.rate = rate
+		self.idle = idle
+		self.active = 0
+		self.fetched = 0
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def touch(self):
+		self.active = time.time()
+
+	def start(self):
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+
+	def waitForIdle(self):
+		"""Returns False if stopped while waiting"""
+		paused = False
+		while not self.stopped.is_set():
+			quiet = time.time() - self.active
+			if quiet >= self.idle:
+				return True
+			if not paused:
+				metrics.increment("prefetch.pauses")
+				paused = True
+			self.stopped.wait(self.idle - quiet)
+		return False
+
+	def spend(self, size):
+		"""Waits out the time size bytes take at the budgeted rate"""
+		self.fetched += size
+		metrics.increment("prefetch.bytes", size)
+		self.stopped.wait(float(size) / self.rate)
+
+	def run(self):
+		pending = collections.deque(self.roots)
+		metrics.set("prefetch.done", 0)
+		while pending and self.waitForIdle():
+			path = pending.popleft()
+			metrics.set("prefetch.pending_directories", len(pending))
+			try:
+				with requestPriority(tnfs_priority.BULK, "prefetch"):
+					pending.extend(self.prefetchDirectory(path))
+			except (socket.error, IOError):
+				metrics.increment("prefetch.errors")
+		metrics.set("prefetch.pending_directories", len(pending))
+		metrics.set("prefetch.done", 0 if pending else 1)
+
+	def prefetchDirectory(self, path):
+		"""Caches a listing and the attributes in it, reads the files in and returns the
+		subdirectories"""
+		names = self.session.ListDir(path)
+		self.cache.setDirectory(path, names)
+		metrics.increment("prefetch.directories")
+		directories = []
+		files = []
+		for child, reply, attributes in self.session.StatMany([fullPath(path, name) for name in names]):
+			self.cache.setAttributes(child, reply, attributes)
+			if reply != 0:
+				continue
+			if attributes.mode & 0170000 == 0040000:
+				directories.append(child)
+			else:
+				files.append((child, attributes))
+		for child, attributes in sorted(files):
+			if self.blocks is not None and self.fetched >= self.blocks.capacity:
+				## Anything more would only push out what was prefetched before
+				break
+			if not self.waitForIdle():
+				break
+			self.prefetchFile(child, attributes)
+			metrics.increment("prefetch.files")
+		return sorted(directories)
+
+	def prefetchFile(self, path, attributes):
+		version = (attributes.size, attributes.mtime)
+		count = (attributes.size + self.block_size - 1) // self.block_size
+		if self.blocks is None:
+			for number in range(count):
+				if not self.waitForIdle():
+					return
+				reply, data = self.session.ReadAt(path, number * self.block_size, self.block_size)
+				if reply != 0:
+					return
+				self.spend(len(data))
+			return
+
+		reader = None
+		try:
+			for number in range(count):
+				key = (path, version, number)
+				if self.blocks.contains(key):
+					continue
+				if self.fetched >= self.blocks.capacity or not self.waitForIdle():
+					return
+				if reader is None:
+					reply, reader = self.session.Open(path, tnfs_flag.O_RDONLY)
+					if reply != 0:
+						return
+				if self.session.LSeek(reader, number * self.block_size, os.SEEK_SET) != 0:
+					return
+				data = bytearray(self.block_size)
+				reply, size = self.session.ReadInto(reader, data)
+				if size == 0:
+					return
+				self.blocks.get(key, lambda: (0, str(data[:size])))
+				self.spend(size)
+		finally:
+			if reader is not None:
+				self.session.Close(reader)
@@ -0,0 +1,513 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2012 Radu Cristescu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import sys
+import stat
+import errno
+import struct
+import signal
+import socket
+import marshal
+import optparse
+import functools
+import threading
+import collections
+import SocketServer
+
+import tnfs_client
+from tnfs_client import metrics, tnfs_flag, StatResponse, TnfsEOF
+from tnfs_cache import MetadataCache, BlockCache
+
+DefaultSocket = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "tnfs-cached-%d.sock" % os.getuid())
+
+## Calls that go to the daemon's session unchanged, apart from invalidating what they modify
+Forwarded = ("OpenDir", "ReadDir", "SeekDir", "TellDir", "CloseDir", "Open", "Close", "LSeek",
+	"MkDir", "RmDir", "Unlink", "Rename", "ChMod", "GetFilesystemSize", "GetFilesystemFree")
+
+## Messages are marshalled tuples with a length in front: (method, args) from the client,
+## (0, result) or (1, errno, message) back from the daemon
+def writeMessage(stream, message):
+	data = marshal.dumps(message)
+	stream.write(struct.pack("<I", len(data)) + data)
+	stream.flush()
+
+def readMessage(stream):
+	header = stream.read(4)
+	if len(header) < 4:
+		return None
+	length, = struct.unpack("<I", header)
+	return marshal.loads(stream.read(length))
+
+class Backend(object):
+	"""The session to one server, with its metadata cache. Every client of that server shares
+	it, along with the daemon's block cache"""
+	MaxReaders = 32
+
+	def __init__(self, address, blocks, block_size = 16384, attr_ttl = 1.0, dir_ttl = 1.0):
+		self.address = address
+		self.session = tnfs_client.Session(address)
+		self.metadata = MetadataCache(attr_ttl, dir_ttl)
+		self.blocks = blocks
+		self.block_size = block_size
+		## Read-only handles used to fill the block cache, with their file positions
+		self.readers = collections.OrderedDict()
+		self.read_lock = threading.Lock()
+
+	def key(self, path):
+		return (self.address, path)
+
+	def Stat(self, path):
+		cached = self.metadata.getAttributes(path)
+		if cached is None:
+			cached = self.session.Stat(path)
+			self.metadata.setAttributes(path, *cached)
+		return cached
+
+	def StatMany(self, paths):
+		results = []
+		missing = []
+		for path in paths:
+			cached = self.metadata.getAttributes(path)
+			if cached is None:
+				missing.append(path)
+			else:
+				results.append((path,) + cached)
+		for path, reply, attributes in self.session.StatMany(missing):
+			self.metadata.setAttributes(path, reply, attributes)
+			results.append((path, reply, attributes))
+		return results
+
+	def ListDir(self, path):
+		names = self.metadata.getDirectory(path)
+		if names is None:
+			names = self.session.ListDir(path)
+			self.metadata.setDirectory(path, names)
+		return names
+
+	def _Fetch(self, path, number):
+		with self.read_lock:
+			reader = self.readers.pop(path, None)
+			if reader is None:
+				reply, fd = self.session.Open(path, tnfs_flag.O_RDONLY)
+				if reply != 0:
+					return reply, None
+				reader = [fd, 0]
+			self.readers[path] = reader
+			while len(self.readers) > self.MaxReaders:
+				_, (old_fd, _) = self.readers.popitem(last = False)
+				self.session.Close(old_fd)
+
+			position = number * self.block_size
+			if reader[1] != position:
+				reply = self.session.LSeek(reader[0], position, os.SEEK_SET)
+				if reply != 0:
+					return reply, None
+			data = bytearray(self.block_size)
+			reply, count = self.session.ReadInto(reader[0], data)
+			reader[1] = position + count
+		if count == 0 and reply not in (0, TnfsEOF):
+			return reply, None
+		return 0, str(data[:count])
+
+	def ReadAt(self, path, offset, length):
+		"""Reads through the block cache. Blocks belong to the file's current size and
+		modification time, so a changed file never returns old blocks"""
+		reply, attributes = self.Stat(path)
+		if reply != 0:
+			return reply, None
+		version = (attributes.size, attributes.mtime)
+		end = min(offset + length, attributes.size)
+		if offset >= end:
+			return 0, ""
+		first = offset // self.block_size
+		blocks = []
+		for number in range(first, (end - 1) // self.block_size + 1):
+			reply, block = self.blocks.get((self.key(path), version, number), functools.partial(self._Fetch, path, number))
+			if reply != 0:
+				return reply, None
+			blocks.append(block)
+			if len(block) < self.block_size:
+				break
+		start = offset - first * self.block_size
+		return 0, "".join(blocks)[start:start + end - offset]
+
+	def invalidate(self, path):
+		self.metadata.invalidate(path)
+		self.blocks.invalidate(self.key(path))
+		with self.read_lock:
+			reader = self.readers.pop(path, None)
+		if reader is not None:
+			self.session.Close(reader[0])
+
+class ClientHandler(SocketServer.StreamRequestHandler):
+	"""Runs the calls of one client connection. Handles the client leaves open are closed when
+	it goes away"""
+	def handle(self):
+		self.backend = None
+		self.files = set()
+		self.dirs = set()
+		try:
+			while True:
+				request = readMessage(self.rfile)
+				if request is None:
+					break
+				method, args = request
+				try:
+					result = (0, self.call(method, args))
+				except (IOError, OSError), e:
+					result = (1, e.errno or errno.EIO, e.strerror or str(e))
+				except tnfs_client.ProtocolError, e:
+					## A malformed reply from the server fails the call, not the connection and its handles
+					metrics.increment("daemon.malformed")
+					result = (1, errno.EIO, str(e))
+				writeMessage(self.wfile, result)
+		finally:
+			self.release()
+
+	def call(self, method, args):
+		metrics.increment("daemon.calls")
+		if method == "Attach":
+			return self.do_Attach(*args)
+		if self.backend is None:
+			raise IOError(errno.ENOTCONN, "Not attached to a server")
+		handler = getattr(self, "do_" + method, None)
+		if handler is not None:
+			return handler(*args)
+		if method in Forwarded:
+			return getattr(self.backend.session, method)(*args)
+		raise IOError(errno.ENOSYS, "Unknown call '%s'" % method)
+
+	def release(self):
+		if self.backend is None:
+			return
+		try:
+			for fd in self.files:
+				self.backend.session.Close(fd)
+			for handle in self.dirs:
+				self.backend.session.CloseDir(handle)
+		except socket.error:
+			pass
+
+	def do_Attach(self, address):
+		self.backend = self.server.backend(tuple(address))
+		session = self.backend.session
+		return {"session": session.session, "version": session.version, "read_size": session.read_size, "write_size": session.write_size}
+
+	def do_Stat(self, path):
+		reply, attributes = self.backend.Stat(path)
+		return reply, attributes.toWire()
+
+	def do_StatMany(self, paths):
+		return [(path, reply, attributes.toWire()) for path, reply, attributes in self.backend.StatMany(paths)]
+
+	def do_ListDir(self, path):
+		return self.backend.ListDir(path)
+
+	def do_ReadAt(self, path, offset, length):
+		return self.backend.ReadAt(path, offset, length)
+
+	def do_Open(self, path, flags = 0, mode = 0):
+		reply, fd = self.backend.session.Open(path, flags, mode)
+		if flags & (tnfs_flag.O_CREAT | tnfs_flag.O_TRUNC):
+			self.backend.invalidate(path)
+		if reply == 0:
+			self.files.add(fd)
+		return reply, fd
+
+	def do_Close(self, fd):
+		self.files.discard(fd)
+		return self.backend.session.Close(fd)
+
+	def do_OpenDir(self, path):
+		reply, handle = self.backend.session.OpenDir(path)
+		if reply == 0:
+			self.dirs.add(handle)
+		return reply, handle
+
+	def do_CloseDir(self, handle):
+		self.dirs.discard(handle)
+		return self.backend.session.CloseDir(handle)
+
+	def do_Read(self, fd, size):
+		reply, data = self.backend.session.Read(fd, size)
+		return reply, str(data) if data is not None else None
+
+	def do_Write(self, fd, data):
+		result = self.backend.session.Write(fd, data)
+		tracked = self.backend.session.files.get(fd)
+		if tracked is not None:
+			self.backend.invalidate(tracked.path)
+		return result
+
+	def modify(self, method, paths, args):
+		try:
+			return getattr(self.backend.session, method)(*args)
+		finally:
+			for path in paths:
+				self.backend.invalidate(path)
+
+	def do_MkDir(self, path):
+		return self.modify("MkDir", [path], (path,))
+
+	def do_RmDir(self, path):
+		return self.modify("RmDir", [path], (path,))
+
+	def do_Unlink(self, path):
+		return self.modify("Unlink", [path], (path,))
+
+	def do_ChMod(self, path, mode):
+		return self.modify("ChMod", [path], (path, mode))
+
+	def do_Rename(self, source, destination):
+		return self.modify("Rename", [source, destination], (source, destination))
+
+	def do_MutateMany(self, operations):
+		operations = [tuple(operation) for operation in operations]
+		try:
+			return list(self.backend.session.MutateMany(operations))
+		finally:
+			for operation in operations:
+				for path in operation[1:]:
+					self.backend.invalidate(path)
+
+	def do_Metrics(self):
+		return metrics.format()
+
+class CacheDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	"""Owns the TNFS sessions, metadata caches and block cache of every mount and CLI on this
+	host. Clients talk to it over a Unix socket, through CachedSession"""
+	daemon_threads = True
+
+	def __init__(self, path = DefaultSocket, capacity = 64 << 20, block_size = 16384, attr_ttl = 1.0, dir_ttl = 1.0):
+		if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+			os.unlink(path)
+		SocketServer.UnixStreamServer.__init__(self, path, ClientHandler)
+		os.chmod(path, 0600)
+		self.path = path
+		self.lock = threading.Lock()
+		self.backends = {}
+		self.blocks = BlockCache(capacity)
+		self.block_size = block_size
+		self.attr_ttl = attr_ttl
+		self.dir_ttl = dir_ttl
+
+	def backend(self, address):
+		with self.lock:
+			if address not in self.backends:
+				self.backends[address] = Backend(address, self.blocks, self.block_size, self.attr_ttl, self.dir_ttl)
+			return self.backends[address]
+
+	def server_close(self):
+		SocketServer.UnixStreamServer.server_close(self)
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		for backend in self.backends.values():
+			try:
+				backend.session.Umount()
+			except socket.error:
+				pass
+
+class CachedSession(object):
+	"""Stands in for a Session, with every call made by the cache daemon. Stat, StatMany,
+	ListDir and ReadAt are answered from the daemon's caches.
+
+	Read-only opens are checked against the daemon's cached attributes and get a handle of
+	ours, negative to tell it apart. The file is only opened on the server if that handle is
+	read from or seeked to the end, as reads by path go through ReadAt"""
+	def __init__(self, address, path = DefaultSocket):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(path)
+		self.rfile = self.sock.makefile("rb")
+		self.wfile = self.sock.makefile("wb")
+		self.lock = threading.Lock()
+		## {our handle: [path, flags, mode, position, daemon handle or None]}
+		self.lazy = {}
+		self.next_lazy = -1
+		info = self.call("Attach", tuple(address))
+		self.address = address
+		self.session = info["session"]
+		self.version = info["version"]
+		self.read_size = info["read_size"]
+		self.write_size = info["write_size"]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.close()
+
+	def close(self):
+		self.rfile.close()
+		self.wfile.close()
+		self.sock.close()
+
+	def __getattr__(self, name):
+		if name not in Forwarded:
+			raise AttributeError(name)
+		return functools.partial(self.call, name)
+
+	def call(self, method, *args):
+		with self.lock:
+			writeMessage(self.wfile, (method, args))
+			result = readMessage(self.rfile)
+		if result is None:
+			raise socket.error(errno.ECONNRESET, "The cache daemon went away")
+		if result[0] != 0:
+			raise socket.error(result[1], result[2])
+		return result[1]
+
+	def Stat(self, path):
+		reply, wire = self.call("Stat", path)
+		return reply, StatResponse().fromWire(wire)
+
+	def StatMany(self, paths, window = 16):
+		for path, reply, wire in self.call("StatMany", list(paths)):
+			yield path, reply, StatResponse().fromWire(wire)
+
+	def ListDir(self, path):
+		return self.call("ListDir", path)
+
+	def ReadAt(self, path, offset, length):
+		reply, data = self.call("ReadAt", path, offset, length)
+		return reply, bytearray(data) if data is not None else None
+
+	## Reads by path always go through the block cache, there's nothing to set up
+	def OpenStriped(self, path):
+		pass
+
+	def CloseStriped(self, path):
+		pass
+
+	def Open(self, path, flags = 0, mode = 0):
+		if flags & ~0x03 or flags & 0x03 not in (0, tnfs_flag.O_RDONLY):
+			return self.call("Open", path, flags, mode)
+		reply, attributes = self.Stat(path)
+		if reply != 0:
+			return reply, None
+		if not stat.S_ISREG(attributes.mode):
+			return self.call("Open", path, flags, mode)
+		with self.lock:
+			handle = self.next_lazy
+			self.next_lazy -= 1
+			self.lazy[handle] = [path, flags, mode, 0, None]
+		metrics.increment("daemon.lazy_opens")
+		return 0, handle
+
+	def _Opened(self, fd):
+		"""The daemon's handle for one of ours, opening the file now if it wasn't yet"""
+		with self.lock:
+			entry = self.lazy.get(fd)
+		if entry is None:
+			return fd, 0
+		if entry[4] is None:
+			path, flags, mode, position, _ = entry
+			reply, handle = self.call("Open", path, flags, mode)
+			if reply != 0:
+				return None, reply
+			if position != 0:
+				reply = self.call("LSeek", handle, position, os.SEEK_SET)
+				if reply != 0:
+					self.call("Close", handle)
+					return None, reply
+			entry[4] = handle
+		return entry[4], 0
+
+	def LSeek(self, fd, offset, whence):
+		with self.lock:
+			entry = self.lazy.get(fd)
+			if entry is not None and entry[4] is None and whence in (os.SEEK_SET, os.SEEK_CUR):
+				entry[3] = offset if whence == os.SEEK_SET else entry[3] + offset
+				return 0
+		handle, reply = self._Opened(fd)
+		if handle is None:
+			return reply
+		return self.call("LSeek", handle, offset, whence)
+
+	def Close(self, fd):
+		with self.lock:
+			entry = self.lazy.pop(fd, None)
+		if entry is None:
+			return self.call("Close", fd)
+		if entry[4] is None:
+			return 0
+		return self.call("Close", entry[4])
+
+	def Read(self, fd, size):
+		handle, reply = self._Opened(fd)
+		if handle is None:
+			return reply, None
+		reply, data = self.call("Read", handle, size)
+		return reply, bytearray(data) if data is not None else None
+
+	def Write(self, fd, data):
+		return self.call("Write", fd, data.tobytes() if isinstance(data, memoryview) else str(data))
+
+	def MutateMany(self, operations, window = 16):
+		for number, reply in self.call("MutateMany", list(operations)):
+			yield number, reply
+
+	def Metrics(self):
+		return self.call("Metrics")
+
+	def GetFile(self, path):
+		reply, attributes = self.Stat(path)
+		if reply != 0:
+			return None
+		data = bytearray()
+		while len(data) < attributes.size:
+			reply, chunk = self.ReadAt(path, len(data), 65536)
+			if reply != 0 or len(chunk) == 0:
+				break
+			data += chunk
+		return data
+
+	def PutFile(self, path, data):
+		reply, fd = self.Open(path, tnfs_flag.O_WRONLY | tnfs_flag.O_CREAT | tnfs_flag.O_TRUNC, 0600)
+		if fd is None:
+			print "Access denied"
+			return
+		for pos in range(0, len(data), 65536):
+			self.Write(fd, data[pos:pos + 65536])
+		self.Close(fd)
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage = "%prog [options]", description = "Shares TNFS sessions and caches between the mounts and CLI sessions of this host")
+	parser.add_option("--socket", default = DefaultSocket, help = "Unix socket to listen on (default %default)")
+	parser.add_option("--cache-size", type = "int", default = 64, help = "Megabytes of file blocks to cache (default %default)")
+	parser.add_option("--block-size", type = "int", default = 16384, help = "Bytes per cached block (default %default)")
+	parser.add_option("--attr-ttl", type = "float", default = 1.0, help = "Seconds to cache file attributes for (default %default)")
+	parser.add_option("--dir-ttl", type = "float", default = 1.0, help = "Seconds to cache directory listings for (default %default)")
+	options, _ = parser.parse_args()
+
+	daemon = CacheDaemon(options.socket, options.cache_size << 20, options.block_size, options.attr_ttl, options.dir_ttl)
+	print "Serving on %s" % options.socket
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		daemon.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		daemon.server_close()
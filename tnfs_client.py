@@ -27,6 +27,16 @@ import socket
 import sys
 import os
 import stat
+import time
+import threading
+import collections
+import Queue
+import errno
+import functools
+import contextlib
+import random
+import timeit
+import json
 
 def getCstr(data, pos):
 	end = data.find("\0", pos)
@@ -75,6 +85,10 @@ def flagsToTNFS(flags):
 
 	return tnfs_flags
 
+class ProtocolError(ValueError):
+	"""Raised when a datagram can't be decoded as the expected message"""
+	pass
+
 class MessageBase(object):
 	TnfsCmd = None
 	def __init__(self):
@@ -96,13 +110,19 @@ class MessageBase(object):
 		return struct.pack("<HBB", self.conn_id, self.retry, self.command) + self.do_ExtraToWire() + self.do_DataToWire()
 
 	def fromWire(self, data):
-		conn_id, retry, command = struct.unpack("<HBB", data[:4])
+		try:
+			conn_id, retry, command = struct.unpack("<HBB", data[:4])
+		except struct.error, e:
+			raise ProtocolError("Truncated header: %s" % e)
 		if command != self.TnfsCmd:
-			raise ValueError, "Wire data isn't for this command"
+			raise ProtocolError, "Wire data isn't for this command"
 
 		self.setSession(conn_id).setRetry(retry)
-		data_pos = self.do_ExtraFromWire(data[4:])
-		self.do_DataFromWire(data[4 + data_pos:])
+		try:
+			data_pos = self.do_ExtraFromWire(data[4:])
+			self.do_DataFromWire(data[4 + data_pos:])
+		except (struct.error, IndexError, TypeError), e:
+			raise ProtocolError("Malformed %s: %s" % (self.__class__.__name__, e))
 		return self
 
 	def do_ExtraToWire(self):
@@ -251,6 +271,10 @@ class ReadDir(Command):
 	def do_DataFromWire(self, data):
 		self.setHandle(*struct.unpack("B", data[0]))
 
+	def packInto(self, buffer):
+		struct.pack_into("<HBBB", buffer, 0, self.conn_id, self.retry, self.command, self.handle)
+		return 5
+
 class ReadDirResponse(Response):
 	TnfsCmd = ReadDir.TnfsCmd
 	def __init__(self):
@@ -286,6 +310,62 @@ class CloseDir(Command):
 class CloseDirResponse(Response):
 	TnfsCmd = CloseDir.TnfsCmd
 
+class SeekDir(Command):
+	TnfsCmd = 0x16
+	def __init__(self):
+		Command.__init__(self)
+		self.setHandle(None).setPosition(None)
+
+	def setHandle(self, handle):
+		self.handle = handle
+		return self
+
+	def setPosition(self, position):
+		self.position = position
+		return self
+
+	def do_DataToWire(self):
+		return struct.pack("<BI", self.handle, self.position)
+
+	def do_DataFromWire(self, data):
+		handle, position = struct.unpack("<BI", data[:5])
+		self.setHandle(handle).setPosition(position)
+
+class SeekDirResponse(Response):
+	TnfsCmd = SeekDir.TnfsCmd
+
+class TellDir(Command):
+	TnfsCmd = 0x15
+	def __init__(self):
+		Command.__init__(self)
+		self.setHandle(None)
+
+	def setHandle(self, handle):
+		self.handle = handle
+		return self
+
+	def do_DataToWire(self):
+		return struct.pack("B", self.handle)
+
+	def do_DataFromWire(self, data):
+		self.setHandle(*struct.unpack("B", data[0]))
+
+class TellDirResponse(Response):
+	TnfsCmd = TellDir.TnfsCmd
+	def __init__(self):
+		Response.__init__(self)
+		self.setPosition(None)
+
+	def setPosition(self, position):
+		self.position = position
+		return self
+
+	def do_DataToWire(self):
+		return struct.pack("<I", self.position) if self.reply == 0 else ""
+
+	def do_DataFromWire(self, data):
+		self.setPosition(struct.unpack("<I", data[:4])[0] if self.reply == 0 else None)
+
 class MkDir(Command):
 	TnfsCmd = 0x13
 	def __init__(self):
@@ -388,6 +468,13 @@ class Read(Command):
 		fd, size = struct.unpack("<BH", data)
 		self.setFD(fd).setSize(size)
 
+	def packInto(self, buffer):
+		"""Encodes the message at the start of a bytearray and returns its length, or raises
+		ProtocolError if it doesn't fit. Only the messages sent most often have it, the others
+		are sent from toWire"""
+		struct.pack_into("<HBBBH", buffer, 0, self.conn_id, self.retry, self.command, self.fd, self.size)
+		return 7
+
 class ReadResponse(Response):
 	TnfsCmd = Read.TnfsCmd
 	def __init__(self):
@@ -403,7 +490,7 @@ class ReadResponse(Response):
 		return self
 
 	def do_DataToWire(self):
-		return struct.pack("<H", self.size) if self.reply == 0 else ""
+		return struct.pack("<H", self.size) + self.data if self.reply == 0 else ""
 
 	def do_DataFromWire(self, data):
 		self.setSize(struct.unpack("<H", data[:2])[0] if self.reply == 0 else None)
@@ -430,6 +517,15 @@ class Write(Command):
 		fd, size = struct.unpack("<BH", data[:3])
 		self.setFD(fd).setData(data[3:])
 
+	def packInto(self, buffer):
+		## The payload can be a memoryview of the caller's data, copied once straight into the datagram
+		size = len(self.data)
+		if 7 + size > len(buffer):
+			raise ProtocolError("Write of %d bytes doesn't fit a %d byte buffer" % (size, len(buffer)))
+		struct.pack_into("<HBBBH", buffer, 0, self.conn_id, self.retry, self.command, self.fd, size)
+		buffer[7:7 + size] = self.data
+		return 7 + size
+
 class WriteResponse(Response):
 	TnfsCmd = Write.TnfsCmd
 	def __init__(self):
@@ -481,6 +577,16 @@ class Stat(Command):
 	def do_DataFromWire(self, data):
 		self.setPath(getCstr(data, 0)[0])
 
+	def packInto(self, buffer):
+		size = len(self.path)
+		## Slice assignment would grow the buffer instead of failing
+		if 5 + size > len(buffer):
+			raise ProtocolError("Stat of a %d byte path doesn't fit a %d byte buffer" % (size, len(buffer)))
+		struct.pack_into("<HBB", buffer, 0, self.conn_id, self.retry, self.command)
+		buffer[4:4 + size] = self.path
+		buffer[4 + size] = 0
+		return 5 + size
+
 class StatResponse(Response):
 	TnfsCmd = Stat.TnfsCmd
 	def __init__(self):
@@ -524,6 +630,8 @@ class StatResponse(Response):
 		return self
 
 	def do_DataToWire(self):
+		if self.reply != 0:
+			return ""
 		return struct.pack("<HHHIIII", self.mode, self.uid, self.gid, self.size, self.atime, self.mtime, self.ctime) + self.user + "\0" + self.group + "\0"
 
 	def do_DataFromWire(self, data):
@@ -568,6 +676,10 @@ class LSeek(Command):
 		fd, seektype, seekposition = struct.unpack("<BBi", data)
 		self.setFD(fd).setSeekType(seektype).setSeekPosition(seekposition)
 
+	def packInto(self, buffer):
+		struct.pack_into("<HBBBBi", buffer, 0, self.conn_id, self.retry, self.command, self.fd, self.seektype, self.seekposition)
+		return 10
+
 class LSeekResponse(Response):
 	TnfsCmd = LSeek.TnfsCmd
 
@@ -607,9 +719,9 @@ class ChMod(Command):
 	def do_DataToWire(self):
 		return struct.pack("<H", self.mode) + self.path + "\0"
 
-	def do_DataFromWire(self):
-		mode, _ = struct.unpack("<H", data[:2])
-		path = getCstr(data, 2)
+	def do_DataFromWire(self, data):
+		mode, = struct.unpack("<H", data[:2])
+		path, _ = getCstr(data, 2)
 		self.setMode(mode).setPath(path)
 
 class ChModResponse(Response):
@@ -655,7 +767,7 @@ class SizeResponse(Response):
 		return self
 
 	def do_DataToWire(self):
-		return struct.pack("<I", self.size)
+		return struct.pack("<I", self.size) if self.reply == 0 else ""
 
 	def do_DataFromWire(self, data):
 		self.setSize(struct.unpack("<I", data)[0] if self.reply == 0 else None)
@@ -674,7 +786,7 @@ class FreeResponse(Response):
 		return self
 
 	def do_DataToWire(self):
-		return struct.pack("<I", self.free)
+		return struct.pack("<I", self.free) if self.reply == 0 else ""
 
 	def do_DataFromWire(self, data):
 		self.setFree(struct.unpack("<I", data)[0] if self.reply == 0 else None)
@@ -685,6 +797,8 @@ klasses = [
 	OpenDir,
 	ReadDir,
 	CloseDir,
+	SeekDir,
+	TellDir,
 	MkDir,
 	RmDir,
 	Open,
@@ -701,6 +815,7 @@ klasses = [
 ]
 
 Commands = {klass.TnfsCmd: klass for klass in klasses}
+Responses = {klass.TnfsCmd: globals()[klass.__name__ + "Response"] for klass in klasses}
 
 def Test(klass, initfunc):
 	print "--" + klass.__name__
@@ -718,7 +833,16 @@ def Test(klass, initfunc):
 	else:
 		raise RuntimeError, "Test of '%s' failed" % klass.__name__
 
-def RunTests():
+## Written out from the TNFS protocol specification, separately from the message classes, so a
+## wrong number in a class can't go unnoticed: 0x17 and 0x18 are OPENDIRX and READDIRX
+SpecCommands = {
+	"Mount": 0x00, "Umount": 0x01,
+	"OpenDir": 0x10, "ReadDir": 0x11, "CloseDir": 0x12, "MkDir": 0x13, "RmDir": 0x14, "TellDir": 0x15, "SeekDir": 0x16,
+	"Read": 0x21, "Write": 0x22, "Close": 0x23, "Stat": 0x24, "LSeek": 0x25, "Unlink": 0x26, "ChMod": 0x27, "Rename": 0x28, "Open": 0x29,
+	"Size": 0x30, "Free": 0x31,
+}
+
+def RunTests(seed = None, rounds = 200):
 	Test(Mount, lambda m: m.setSession(0xbeef).setLocation("/home/tnfs").setUserPassword("username", "password"))
 	Test(MountResponse, lambda m: m.setSession(0xbeef).setVersion((2, 6)).setRetryDelay(4999))
 	Test(MountResponse, lambda m: m.setSession(0xbeef).setReply(255))
@@ -733,17 +857,859 @@ def RunTests():
 	Test(CloseDir, lambda m: m.setSession(0xbeef).setHandle(0x1f))
 	Test(CloseDirResponse, lambda m: m.setSession(0xbeef).setReply(0))
 	Test(CloseDirResponse, lambda m: m.setSession(0xbeef).setReply(255))
+	Test(ChMod, lambda m: m.setSession(0xbeef).setMode(0644).setPath("/games/manic.tap"))
+
+	print "--Command numbers"
+	for klass in klasses:
+		if SpecCommands[klass.__name__] != klass.TnfsCmd:
+			raise RuntimeError, "%s is command 0x%02x in the TNFS specification, not 0x%02x" % (klass.__name__, SpecCommands[klass.__name__], klass.TnfsCmd)
+
+	print "--Mutation dependencies"
+	for operations, expected in (
+		([("unlink", "/a/x"), ("unlink", "/a/y"), ("rmdir", "/a")], [set(), set(), set([0, 1])]),
+		([("mkdir", "/a"), ("mkdir", "/a/b"), ("mkdir", "/c")], [set(), set([0]), set()]),
+		([("unlink", "/a/b/c"), ("rename", "/a", "/z")], [set(), set([0])]),
+		([("rename", "/a", "/z"), ("unlink", "/a/b/c"), ("mkdir", "/z/d")], [set(), set([0]), set([0])])):
+		dependencies = mutationDependencies(operations)
+		if dependencies != expected:
+			raise RuntimeError, "Dependencies of %r are %r, not %r" % (operations, dependencies, expected)
+
+	print "--Stale replies after the retransmit deadline"
+	StaleReplyTest()
+	print "--Change detection"
+	ChangeDetectorTest()
+
+	if seed is None:
+		seed = random.randrange(1 << 32)
+	print "--Round trips and fuzzing, seed %d" % seed
+	rng = random.Random(seed)
+	for command in sorted(Commands):
+		for klass in (Commands[command], Responses[command]):
+			for round in range(rounds):
+				RoundTrip(klass, rng)
+			Fuzz(klass, rng)
+	print "*Success*"
+
+## Random but valid contents for every message, used by the round trip, fuzz and benchmark code
+def randomName(rng, length = 32):
+	return "".join(rng.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._-") for i in range(rng.randint(1, length)))
+
+def randomPath(rng):
+	return "/" + "/".join(randomName(rng, 12) for i in range(rng.randint(1, 4)))
+
+def randomData(rng, length = 1024):
+	return "".join(chr(rng.randint(0, 255)) for i in range(rng.randint(0, length)))
+
+def randomReply(rng, message, success):
+	if not success:
+		return message.setReply(rng.randint(1, 255))
+	return success(message.setReply(0))
+
+def u8(rng):
+	return rng.randint(0, 0xff)
+
+def u16(rng):
+	return rng.randint(0, 0xffff)
+
+def u32(rng):
+	return rng.randint(0, 0xffffffff)
+
+Generators = {
+	Mount: lambda rng, m: m.setVersion((u8(rng), u8(rng))).setLocation(randomPath(rng)).setUserPassword(randomName(rng), randomName(rng)),
+	MountResponse: lambda rng, m: randomReply(rng, m.setVersion((u8(rng), u8(rng))), rng.random() < 0.8 and (lambda m: m.setRetryDelay(u16(rng)))),
+	Umount: lambda rng, m: m,
+	UmountResponse: lambda rng, m: m.setReply(u8(rng)),
+	OpenDir: lambda rng, m: m.setPath(randomPath(rng)),
+	OpenDirResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setHandle(u8(rng)))),
+	ReadDir: lambda rng, m: m.setHandle(u8(rng)),
+	ReadDirResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setPath(randomName(rng)))),
+	CloseDir: lambda rng, m: m.setHandle(u8(rng)),
+	CloseDirResponse: lambda rng, m: m.setReply(u8(rng)),
+	SeekDir: lambda rng, m: m.setHandle(u8(rng)).setPosition(u32(rng)),
+	SeekDirResponse: lambda rng, m: m.setReply(u8(rng)),
+	TellDir: lambda rng, m: m.setHandle(u8(rng)),
+	TellDirResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setPosition(u32(rng)))),
+	MkDir: lambda rng, m: m.setPath(randomPath(rng)),
+	MkDirResponse: lambda rng, m: m.setReply(u8(rng)),
+	RmDir: lambda rng, m: m.setPath(randomPath(rng)),
+	RmDirResponse: lambda rng, m: m.setReply(u8(rng)),
+	Open: lambda rng, m: m.setFlags(u16(rng)).setMode(u16(rng)).setPath(randomPath(rng)),
+	OpenResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setFD(u8(rng)))),
+	Read: lambda rng, m: m.setFD(u8(rng)).setSize(u16(rng)),
+	ReadResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setData(randomData(rng)).setSize(len(m.data)))),
+	Write: lambda rng, m: m.setFD(u8(rng)).setData(randomData(rng)),
+	WriteResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setSize(u16(rng)))),
+	Close: lambda rng, m: m.setFD(u8(rng)),
+	CloseResponse: lambda rng, m: m.setReply(u8(rng)),
+	Stat: lambda rng, m: m.setPath(randomPath(rng)),
+	StatResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setMode(u16(rng)).setUID(u16(rng)).setGID(u16(rng))
+		.setSize(u32(rng)).setAtime(u32(rng)).setMtime(u32(rng)).setCtime(u32(rng)).setUser(randomName(rng)).setGroup(randomName(rng)))),
+	LSeek: lambda rng, m: m.setFD(u8(rng)).setSeekType(rng.randint(0, 2)).setSeekPosition(rng.randint(-0x80000000, 0x7fffffff)),
+	LSeekResponse: lambda rng, m: m.setReply(u8(rng)),
+	Unlink: lambda rng, m: m.setPath(randomPath(rng)),
+	UnlinkResponse: lambda rng, m: m.setReply(u8(rng)),
+	ChMod: lambda rng, m: m.setMode(u16(rng)).setPath(randomPath(rng)),
+	ChModResponse: lambda rng, m: m.setReply(u8(rng)),
+	Rename: lambda rng, m: m.setSourcePath(randomPath(rng)).setDestinationPath(randomPath(rng)),
+	RenameResponse: lambda rng, m: m.setReply(u8(rng)),
+	Size: lambda rng, m: m,
+	SizeResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setSize(u32(rng)))),
+	Free: lambda rng, m: m,
+	FreeResponse: lambda rng, m: randomReply(rng, m, rng.random() < 0.8 and (lambda m: m.setFree(u32(rng)))),
+}
+
+def randomMessage(klass, rng):
+	return Generators[klass](rng, klass().setSession(u16(rng)).setRetry(u8(rng)))
+
+def RoundTrip(klass, rng):
+	"""Encoding, decoding and encoding again must give the same datagram"""
+	message = randomMessage(klass, rng)
+	w = message.toWire()
+	w2 = klass().fromWire(w).toWire()
+	if w != w2:
+		raise RuntimeError, "Round trip of '%s' failed: %r became %r" % (klass.__name__, w, w2)
+	if hasattr(message, "packInto"):
+		buffer = bytearray(len(w) + 16)
+		packed = str(buffer[:message.packInto(buffer)])
+		if packed != w:
+			raise RuntimeError, "packInto of '%s' gave %r instead of %r" % (klass.__name__, packed, w)
+		short = bytearray(len(w) - 1)
+		try:
+			message.packInto(short)
+		except (ProtocolError, struct.error):
+			pass
+		else:
+			raise RuntimeError, "packInto of '%s' didn't notice a buffer too short" % klass.__name__
+		if len(short) != len(w) - 1:
+			raise RuntimeError, "packInto of '%s' resized the buffer" % klass.__name__
+
+def Fuzz(klass, rng, rounds = 50):
+	"""Truncated and garbage datagrams may only fail to decode with a ProtocolError"""
+	w = randomMessage(klass, rng).toWire()
+	candidates = [w[:length] for length in range(len(w))]
+	for round in range(rounds):
+		garbage = list(w[:4] + randomData(rng, 64))
+		if rng.random() < 0.5:
+			garbage[rng.randrange(len(garbage))] = chr(u8(rng))
+		candidates.append("".join(garbage))
+	for candidate in candidates:
+		try:
+			klass().fromWire(candidate)
+		except ProtocolError:
+			pass
+		except Exception, e:
+			raise RuntimeError, "Decoding %r as '%s' raised %r" % (candidate, klass.__name__, e)
+
+BaselineFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "codec_baseline.json")
+
+def StaleReplyTest(burst = 32):
+	"""A Stat against a local stand-in server that answers every request with a burst of
+	replies to the previous sequence number before the real one, with a retransmit delay so
+	short that the stale replies are all read after it has passed"""
+	server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	server.bind(("127.0.0.1", 0))
+	def serve():
+		while True:
+			data, address = server.recvfrom(1024)
+			sequence, command = ord(data[2]), ord(data[3])
+			response = Responses[command]().setSession(0xbeef).setReply(0)
+			if command == Mount.TnfsCmd:
+				response.setVersion((1, 2)).setRetryDelay(1000)
+			elif command == Stat.TnfsCmd:
+				response.setReply(errno.ENOENT)
+				stale = StatResponse().setSession(0xbeef).setRetry((sequence - 1) % 256).setReply(errno.ENOENT).toWire()
+				for copy in range(burst):
+					server.sendto(stale, address)
+			server.sendto(response.setRetry(sequence).toWire(), address)
+	thread = threading.Thread(target = serve, name = "stale-reply-server")
+	thread.daemon = True
+	thread.start()
+	with Session(server.getsockname(), timeout = 5, read_size = Session.DefaultPayload, recover = False) as session:
+		session._RetransmitDelay = lambda: 0.0001
+		reply, _ = session.Stat("/missing")
+	server.close()
+	if reply != errno.ENOENT:
+		raise RuntimeError, "Stat among stale replies returned %r" % reply
+
+def ChangeDetectorTest():
+	"""A file appearing in a directory only drops the directory's listing from the cache,
+	not the attributes and listings of what was already in it"""
+	import tnfs_cache
+	class Tree(object):
+		def __init__(self, modes):
+			self.modes = modes
+		def ListDir(self, path):
+			return sorted(os.path.basename(other) for other in self.modes if os.path.dirname(other) == path)
+		def StatMany(self, paths):
+			for path in paths:
+				yield path, 0, self.attributes(path)
+		def attributes(self, path):
+			return StatResponse().setSession(0).setReply(0).setMode(self.modes[path]).setUID(0).setGID(0).setSize(1).setAtime(1).setMtime(1).setCtime(1).setUser("tnfs").setGroup("tnfs")
+
+	tree = Tree({"/g/a": 0100644, "/g/b": 0100644, "/g/sub": 040755, "/g/sub/x": 0100644})
+	cache = tnfs_cache.MetadataCache(60, 60)
+	for path in tree.modes:
+		cache.setAttributes(path, 0, tree.attributes(path))
+	cache.setDirectory("/g", tree.ListDir("/g"))
+	cache.setDirectory("/g/sub", tree.ListDir("/g/sub"))
+	tree.modes["/g/c"] = 0100644
+	changed = tnfs_cache.ChangeDetector(tree, cache).scan("/g")
+	if changed != ["c"] or cache.getDirectory("/g") is not None:
+		raise RuntimeError, "The new file %r wasn't noticed" % changed
+	kept = [path for path in ("/g/a", "/g/b", "/g/sub", "/g/sub/x") if cache.getAttributes(path) is not None]
+	if len(kept) != 4 or cache.getDirectory("/g/sub") != ["x"]:
+		raise RuntimeError, "A new file dropped what was cached beside it, only %r are left" % kept
+
+class ReferenceWork(object):
+	"""Setter chains and struct calls like the codecs make, but none of their code. Timed in
+	the same run, it turns nanoseconds into a cost that compares across machines"""
+	def __init__(self):
+		self.set(None)
+
+	def set(self, value):
+		self.value = value
+		return self
+
+	def run(self):
+		data = struct.pack("<HBB", 0xbeef, 1, 2) + "reference\0"
+		return self.set(struct.unpack("<HBB", data[:4])).set(data.find("\0", 4))
+
+def RunBenchmarks(baseline = BaselineFile, save = False, tolerance = 0.25, repeat = 7, number = 2000, retries = 3):
+	"""Times encoding and decoding of every message, as multiples of the time ReferenceWork
+	takes on the same machine, and compares with the baseline file. Returns the names that
+	got slower than the tolerance allows"""
+	def timed(function):
+		## Alternating with the reference makes both see the same clock speed and load
+		best, reference = None, None
+		for round in range(repeat):
+			elapsed = timeit.timeit(function, number = number)
+			work = timeit.timeit(lambda: ReferenceWork().run(), number = number)
+			best = min(best, elapsed) if best is not None else elapsed
+			reference = min(reference, work) if reference is not None else work
+		return best * 1e9 / number, best / reference
+
+	rng = random.Random(0)
+	functions = {}
+	for command in sorted(Commands):
+		for klass in (Commands[command], Responses[command]):
+			message = randomMessage(klass, rng)
+			wire = message.toWire()
+			functions[klass.__name__ + ".encode"] = message.toWire
+			functions[klass.__name__ + ".decode"] = lambda klass = klass, wire = wire: klass().fromWire(wire)
+	results = {}
+	costs = {}
+	for name in sorted(functions):
+		results[name], costs[name] = timed(functions[name])
+
+	previous = {}
+	if baseline is not None and os.path.exists(baseline):
+		with open(baseline) as f:
+			previous = json.load(f)
+
+	## Noise only ever makes things slower, so what looks slower is timed again and the best kept
+	for attempt in range(retries):
+		suspects = [name for name in costs if name in previous and costs[name] > previous[name] * (1 + tolerance)]
+		for name in suspects:
+			again = timed(functions[name])
+			if again[1] < costs[name]:
+				results[name], costs[name] = again
+	reference = sum(results[name] / costs[name] for name in results) / len(results)
+
+	slower = []
+	print "Reference work: %.0f ns" % reference
+	print "{0:<28s} {1:>10s} {2:>8s} {3:>9s} {4:>7s}".format("BENCHMARK", "NS/CALL", "COST", "BASELINE", "RATIO")
+	for name in sorted(results):
+		cost = costs[name]
+		if name in previous:
+			ratio = cost / previous[name]
+			if ratio > 1 + tolerance:
+				slower.append(name)
+			print "{0:<28s} {1:>10.0f} {2:>8.2f} {3:>9.2f} {4:>7.2f}{5}".format(name, results[name], cost, previous[name], ratio, " SLOWER" if ratio > 1 + tolerance else "")
+		else:
+			print "{0:<28s} {1:>10.0f} {2:>8.2f} {3:>9s} {4:>7s}".format(name, results[name], cost, "-", "-")
+
+	if save and baseline is not None:
+		with open(baseline, "w") as f:
+			json.dump(dict((name, round(value, 3)) for name, value in costs.items()), f, indent = 1, sort_keys = True)
+		print "Baseline saved to %s" % baseline
+	return slower
+
+class Metrics(object):
+	"""Thread safe counters and gauges, used to tune the client at run time"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.values = {}
+
+	def increment(self, name, amount = 1):
+		with self.lock:
+			self.values[name] = self.values.get(name, 0) + amount
+
+	def set(self, name, value):
+		with self.lock:
+			self.values[name] = value
+
+	def get(self, name, default = 0):
+		with self.lock:
+			return self.values.get(name, default)
+
+	def remove(self, name):
+		with self.lock:
+			self.values.pop(name, None)
+
+	def snapshot(self):
+		with self.lock:
+			values = dict(self.values)
+		calls = values.get("hedge.calls", 0)
+		if calls > 0:
+			values["hedge.rate"] = float(values.get("hedge.sent", 0)) / calls
+		return values
+
+	def format(self):
+		return "".join("%s %s\n" % item for item in sorted(self.snapshot().items()))
+
+metrics = Metrics()
+
+class LatencyTracker(object):
+	"""Keeps a sliding window of round-trip times (in seconds) for one server"""
+	def __init__(self, window = 64, alpha = 0.2):
+		self.lock = threading.Lock()
+		self.window = window
+		self.alpha = alpha
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.samples = collections.deque(maxlen = self.window)
+			self.average = None
+			self.failures = 0
+
+	def record(self, seconds):
+		with self.lock:
+			self.samples.append(seconds)
+			self.average = seconds if self.average is None else self.average + self.alpha * (seconds - self.average)
+			self.failures = 0
+
+	def recordFailure(self):
+		with self.lock:
+			self.failures += 1
+
+	def percentile(self, fraction):
+		with self.lock:
+			if len(self.samples) == 0:
+				return None
+			ordered = sorted(self.samples)
+		return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Cancelled(Exception):
+	pass
+
+## Reply code for requests made on a session the server doesn't know about, e.g. after it restarted
+EBADSESSION = 0xFF
+## The server's reply when reading at the end of a file or directory
+TnfsEOF = 0x21
+
+class SessionLost(socket.error):
+	pass
+
+class TrackedHandle(object):
+	"""What it takes to re-open a file or directory handle after the session was lost. The
+	offset counts bytes read or written for files, and entries read since the last SeekDir
+	position for directories"""
+	def __init__(self, path, server_handle, flags = 0, mode = 0):
+		self.path = path
+		self.server_handle = server_handle
+		self.flags = flags
+		self.mode = mode
+		self.whence = os.SEEK_SET
+		self.offset = 0
+		self.position = None
+
+def recoverable(method):
+	"""Retries a Session method once after the session was re-established"""
+	@functools.wraps(method)
+	def wrapper(self, *args, **kw):
+		if self.reconnecting is not None:
+			raise SessionLost("Reconnecting to %s:%d" % self.address)
+		generation = self.generation
+		try:
+			return method(self, *args, **kw)
+		except (SessionLost, socket.timeout):
+			if not self.Recover(generation):
+				raise
+		metrics.increment("session.retries")
+		return method(self, *args, **kw)
+	return wrapper
+
+def changes(method):
+	"""Makes the Stats and ReadDirs of a Session started after the method, which changes
+	something on the server, is done not join those in flight, which may have missed it"""
+	@functools.wraps(method)
+	def wrapper(self, *args, **kw):
+		try:
+			return method(self, *args, **kw)
+		finally:
+			self._Changed()
+	return wrapper
+
+class CongestionController(object):
+	"""Decides how many pipelined requests may be waiting for a reply at once. The window
+	grows by one per window's worth of answered requests and halves on a timeout, at most
+	once per round trip. An optional max_rate caps the requests per second sent"""
+	def __init__(self, name, initial = 4, minimum = 1, maximum = 64, max_rate = None):
+		self.lock = threading.Lock()
+		self.name = name
+		self.minimum = minimum
+		self.maximum = maximum
+		self.window = float(max(minimum, min(initial, maximum)))
+		self.max_rate = max_rate
+		self.tokens = 1.0
+		self.refilled = time.time()
+		self.decreased = 0
+		self.publish()
+
+	def publish(self):
+		metrics.set("congestion.window." + self.name, int(self.window))
+
+	def rename(self, name):
+		with self.lock:
+			metrics.remove("congestion.window." + self.name)
+			self.name = name
+			self.publish()
+
+	def allowed(self):
+		return int(self.window)
+
+	def onSuccess(self):
+		with self.lock:
+			self.window = min(self.maximum, self.window + 1.0 / self.window)
+			self.publish()
+
+	def onTimeout(self, round_trip):
+		with self.lock:
+			now = time.time()
+			if now - self.decreased < round_trip:
+				return
+			self.decreased = now
+			self.window = max(self.minimum, self.window / 2)
+			self.publish()
+		metrics.increment("congestion.decreases")
+
+	def pace(self):
+		"""Blocks until the rate cap allows sending another request"""
+		if not self.max_rate:
+			return
+		with self.lock:
+			now = time.time()
+			self.tokens = min(max(1.0, self.max_rate / 10.0), self.tokens + (now - self.refilled) * self.max_rate)
+			self.refilled = now
+			self.tokens -= 1
+			delay = -self.tokens / self.max_rate if self.tokens < 0 else 0
+		if delay > 0:
+			metrics.increment("congestion.paced_seconds", delay)
+			time.sleep(delay)
+
+class WorkerPool(object):
+	"""Runs functions on reusable daemon threads. A thread is started only when none is idle,
+	and ends after idle seconds without work"""
+	def __init__(self, name, idle = 30.0):
+		self.name = name
+		self.idle = idle
+		self.lock = threading.Lock()
+		self.tasks = Queue.Queue()
+		## Threads waiting for work that no queued task has claimed yet
+		self.available = 0
+
+	def submit(self, function, *args):
+		with self.lock:
+			self.tasks.put((function, args))
+			if self.available > 0:
+				self.available -= 1
+				return
+		worker = threading.Thread(target = self.run, name = self.name)
+		worker.daemon = True
+		worker.start()
+
+	def run(self):
+		while True:
+			try:
+				function, args = self.tasks.get(timeout = self.idle)
+			except Queue.Empty:
+				with self.lock:
+					if self.tasks.empty():
+						self.available -= 1
+						return
+				continue
+			try:
+				function(*args)
+			except Exception:
+				pass
+			with self.lock:
+				self.available += 1
+
+## Runs both sides of hedged calls
+HedgeWorkers = WorkerPool("hedge")
+
+def hedgedCall(latency, fraction, primary, alternative, minimum_samples = 16):
+	"""Calls primary(). If it hasn't returned within the observed latency percentile, alternative()
+	is started as well, and the result of whichever finishes first is returned.
+
+	Both functions take an Event that is set once a result is in, so that the loser can give up
+	instead of queueing behind other requests on its session, or stop waiting for its reply"""
+	settled = threading.Event()
+	delay = latency.percentile(fraction) if len(latency.samples) >= minimum_samples else None
+	if delay is None:
+		return primary(settled)
+
+	metrics.increment("hedge.calls")
+	results = Queue.Queue()
+	finished = {}
+	def run(name, function):
+		try:
+			outcome = (name, True, function(settled))
+		except Cancelled:
+			metrics.increment("hedge.cancelled")
+			return
+		except Exception, e:
+			outcome = (name, False, e)
+		if outcome[1]:
+			settled.set()
+		finished[name] = time.time()
+		if name == "primary" and "hedge" in finished:
+			metrics.increment("hedge.saved_seconds", finished["primary"] - finished["hedge"])
+		results.put(outcome)
+
+	def start(name, function):
+		HedgeWorkers.submit(run, name, function)
+
+	start("primary", primary)
+	try:
+		name, success, value = results.get(timeout = delay)
+	except Queue.Empty:
+		metrics.increment("hedge.sent")
+		start("hedge", alternative)
+		name, success, value = results.get()
+		if not success:
+			name, success, value = results.get()
+		if success and name == "hedge":
+			metrics.increment("hedge.won")
+
+	if not success:
+		raise value
+	return value
+
+## Metadata changes Session.MutateMany can pipeline: ("mkdir", path), ("rmdir", path),
+## ("unlink", path) and ("rename", source, destination)
+MutationMessages = {
+	"mkdir": lambda path: MkDir().setPath(path),
+	"rmdir": lambda path: RmDir().setPath(path),
+	"unlink": lambda path: Unlink().setPath(path),
+	"rename": lambda source, destination: Rename().setSourcePath(source).setDestinationPath(destination),
+}
+
+## The reply a change sent twice gets when the first copy was carried out, as the server only
+## keeps the reply to the last request
+AlreadyDone = {"mkdir": errno.EEXIST, "rmdir": errno.ENOENT, "unlink": errno.ENOENT}
+
+def pathAncestors(path):
+	"""The directories above a path, innermost first"""
+	while path not in ("/", ""):
+		path = os.path.dirname(path)
+		yield path
+
+def mutationDependencies(operations):
+	"""For each change, the numbers of the earlier ones it must wait for: those on the same
+	path, those on a directory above it and, for a directory, those anywhere below it.
+	Changes to different entries of one directory don't wait for each other"""
+	last = {}
+	## Changes below a directory since the last change to the directory itself
+	below = {}
+	dependencies = []
+	for number, operation in enumerate(operations):
+		paths = set(operation[1:])
+		ancestors = set(ancestor for path in paths for ancestor in pathAncestors(path))
+		earlier = set(last[path] for path in paths | ancestors if path in last)
+		for path in paths:
+			earlier.update(below.pop(path, ()))
+			last[path] = number
+		for ancestor in ancestors:
+			below.setdefault(ancestor, []).append(number)
+		earlier.discard(number)
+		dependencies.append(earlier)
+	return dependencies
+
+def removalPlan(session, paths, recursive = False):
+	"""The changes removing paths, for Session.MutateMany. With recursive, the contents of a
+	directory go first, listed and checked with pipelined Stats"""
+	operations = []
+	attributes = dict((path, (reply, filestat)) for path, reply, filestat in session.StatMany(paths))
+	for path in paths:
+		reply, filestat = attributes[path]
+		if reply != 0 or not stat.S_ISDIR(filestat.mode):
+			operations.append(("unlink", path))
+		elif recursive:
+			entries = [fullPath(path, filename) for filename in session.ListDir(path) if filename not in (".", "..")]
+			operations += removalPlan(session, entries, True)
+			operations.append(("rmdir", path))
+		else:
+			operations.append(("rmdir", path))
+	return operations
+
+class SingleFlight(object):
+	"""Merges concurrent identical calls. While a call for a key is running, callers with the
+	same key wait for it and get its result, counted as name.deduplicated in the metrics. If
+	it raises, each waiting caller makes the call on its own"""
+	def __init__(self, name):
+		self.name = name
+		self.lock = threading.Lock()
+		self.pending = {}
+
+	def call(self, key, function, *args):
+		with self.lock:
+			flight = self.pending.get(key)
+			owner = flight is None
+			if owner:
+				flight = self.pending[key] = [threading.Event(), None, False]
+
+		if not owner:
+			flight[0].wait()
+			if not flight[2]:
+				return function(*args)
+			metrics.increment(self.name + ".deduplicated")
+			return flight[1]
+
+		try:
+			flight[1] = function(*args)
+			flight[2] = True
+		finally:
+			with self.lock:
+				if self.pending.get(key) is flight:
+					del self.pending[key]
+			flight[0].set()
+		return flight[1]
+
+	def forget(self):
+		"""Calls made from now on won't join the ones in flight, whose results may predate a change"""
+		with self.lock:
+			self.pending = {}
+
+class MutationBatcher(object):
+	"""Group commit of metadata changes: a caller finding none in flight sends its change and
+	those that queue up meanwhile as one Session.MutateMany batch, and the others wait for
+	their reply. Batches go out one at a time, so changes keep the order they were made in"""
+	def __init__(self, session, window = 16):
+		self.session = session
+		self.window = window
+		self.condition = threading.Condition()
+		self.queue = []
+		self.sending = False
+
+	def call(self, *operation):
+		"""Makes a change such as ("unlink", path) and returns the reply code"""
+		entry = [operation, None, False, None]
+		with self.condition:
+			self.queue.append(entry)
+			while self.sending and not entry[2]:
+				self.condition.wait()
+			if entry[2]:
+				return self._result(entry)
+			self.sending = True
+
+		try:
+			while True:
+				with self.condition:
+					batch, self.queue = self.queue, []
+				if len(batch) == 0:
+					break
+				metrics.increment("mutations.batches")
+				metrics.increment("mutations.batched", len(batch))
+				try:
+					for number, reply in self.session.MutateMany([item[0] for item in batch], self.window):
+						batch[number][1] = reply
+						batch[number][2] = True
+				except Exception as e:
+					for item in batch:
+						if not item[2]:
+							item[3] = e
+							item[2] = True
+				with self.condition:
+					self.condition.notify_all()
+		finally:
+			with self.condition:
+				## Whoever is still queued takes over
+				self.sending = False
+				self.condition.notify_all()
+		return self._result(entry)
+
+	def _result(self, entry):
+		if entry[3] is not None:
+			raise entry[3]
+		return entry[1]
+
+class tnfs_priority(object):
+	"""Scheduling classes of requests, lower goes first"""
+	METADATA = 0
+	FOREGROUND = 1
+	BULK = 2
+	Names = ("metadata", "foreground", "bulk")
+
+## Commands scheduled as metadata unless the thread asked for another class
+MetadataCommands = frozenset([OpenDir.TnfsCmd, ReadDir.TnfsCmd, SeekDir.TnfsCmd, TellDir.TnfsCmd, CloseDir.TnfsCmd, Stat.TnfsCmd, Size.TnfsCmd, Free.TnfsCmd])
+
+requestContext = threading.local()
+
+@contextlib.contextmanager
+def requestPriority(priority, flow = None):
+	"""Schedules the requests this thread makes inside the block in a priority class. Requests
+	sharing a flow name share one fair share of their class, by default each thread is a flow"""
+	previous = getattr(requestContext, "priority", None), getattr(requestContext, "flow", None)
+	requestContext.priority, requestContext.flow = priority, flow
+	try:
+		yield
+	finally:
+		requestContext.priority, requestContext.flow = previous
+
+class PriorityLock(object):
+	"""Reentrant lock that is handed over by priority rather than arrival order.
+
+	The waiter with the best class goes first. Within a class it is the flow served least
+	recently, so one busy flow can't crowd out the others. A waiter moves up one class for
+	every aging seconds it has waited, so bulk requests are delayed but never starved."""
+	## Flows remembered before the ones served longer ago than every waiter are forgotten
+	MaxFlows = 256
+
+	def __init__(self, aging = 0.5):
+		self.condition = threading.Condition(threading.Lock())
+		self.aging = aging
+		self.owner = None
+		self.owner_priority = None
+		self.count = 0
+		self.waiting = []
+		self.served = {}
+		self.turn = 0
+
+	def _effective(self, waiter, now):
+		priority, flow, arrival, _ = waiter
+		return max(tnfs_priority.METADATA, priority - int((now - arrival) / self.aging))
+
+	def _next(self):
+		now = time.time()
+		return min(self.waiting, key = lambda waiter: (self._effective(waiter, now), self.served.get(waiter[1], -1), waiter[2]))
+
+	def acquire(self, default = tnfs_priority.FOREGROUND):
+		"""Takes the lock in the thread's priority class, or in default if it didn't set one"""
+		me = threading.current_thread()
+		with self.condition:
+			if self.owner is me:
+				self.count += 1
+				return True
+			priority = getattr(requestContext, "priority", None)
+			priority = default if priority is None else priority
+			flow = getattr(requestContext, "flow", None) or me.ident
+			if self.owner is not None or len(self.waiting) > 0:
+				waiter = (priority, flow, time.time(), me)
+				self.waiting.append(waiter)
+				while self.owner is not None or self._next() is not waiter:
+					self.condition.wait()
+				self.waiting.remove(waiter)
+				metrics.increment("scheduler.%s.waits" % tnfs_priority.Names[priority])
+				metrics.increment("scheduler.%s.wait_seconds" % tnfs_priority.Names[priority], time.time() - waiter[2])
+			self.owner = me
+			self.owner_priority = priority
+			self.count = 1
+			self.served[flow] = self.turn
+			self.turn += 1
+			if len(self.served) > self.MaxFlows:
+				self._forget()
+			return True
+
+	def _forget(self):
+		"""Drops the flows served before any waiting one. An unknown flow counts as served
+		longest ago, which is where those were anyway"""
+		oldest = min([self.served.get(waiter[1], -1) for waiter in self.waiting] + [self.turn - 1])
+		for flow in [flow for flow, turn in self.served.iteritems() if turn < oldest]:
+			del self.served[flow]
+
+	def release(self):
+		with self.condition:
+			if self.owner is not threading.current_thread():
+				raise RuntimeError("Releasing a lock this thread doesn't hold")
+			self.count -= 1
+			if self.count == 0:
+				self.owner = None
+				self.condition.notify_all()
+
+	__enter__ = acquire
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.release()
+
+	@contextlib.contextmanager
+	def holding(self, default):
+		self.acquire(default)
+		try:
+			yield
+		finally:
+			self.release()
+
+	def contended(self):
+		"""Whether a waiter of the same or a better class is waiting for the holder"""
+		with self.condition:
+			now = time.time()
+			return any(self._effective(waiter, now) <= self.owner_priority for waiter in self.waiting)
+
+	def yieldTurn(self):
+		"""Lets the waiter due next go first, then waits for the lock again. Only call this
+		between requests, with nothing on the wire, and it does nothing when held recursively"""
+		with self.condition:
+			if self.count != 1 or len(self.waiting) == 0:
+				return
+			priority = self.owner_priority
+		metrics.increment("scheduler.yields")
+		self.release()
+		self.acquire(priority)
+
+## Read sizes probed per server address. Sessions created at the same time share one probe
+NegotiatedSizes = {}
+NegotiatedLock = threading.Lock()
+Negotiated = SingleFlight("probe")
 
 class Session(object):
-	def __init__(self, address):
+	## The TNFS specification only promises 512 byte reads and writes over UDP
+	DefaultPayload = 512
+	ProbeSizes = (32768, 16384, 8192, 4096, 2048, 1024)
+	## Seconds between checks whether a hedged request lost and can stop waiting
+	CancelPoll = 0.01
+
+	def __init__(self, address, timeout = 30, read_size = None, write_size = None, recover = True, recovery_timeout = 1.0, max_window = 64, max_rate = None):
 		self.setSession(None)
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		self.sock.settimeout(30)
+		self.timeout = timeout
 		self.address = (socket.gethostbyname(address[0]), address[1])
 		self.sequence = 0
+		self.lock = PriorityLock()
+		self.latency = LatencyTracker()
+		self.congestion = CongestionController("%s:%d" % self.address, maximum = max_window, max_rate = max_rate)
+		self.hedge_fraction = None
+		self.alternatives = []
+		self.files = {}
+		self.dirs = {}
+		self.next_handle = 1
+		self.stats = SingleFlight("stat")
+		self.listings = SingleFlight("listdir")
+		self.generation = 0
+		self.recover = recover
+		self.recovery_timeout = recovery_timeout
+		self.reconnecting = None
+		self.stop_recovery = threading.Event()
+		self.setPayloadSizes(read_size or self.DefaultPayload, write_size or read_size or self.DefaultPayload)
 
 		reply, ver_maj, ver_min = self.Mount("/")
 		self.version = "%d.%d" % (ver_maj, ver_min)
+		if reply == 0 and read_size is None:
+			## Replicas, hedge alternatives and later mounts of a server reuse its first probe
+			self.setPayloadSizes(Negotiated.call(self.address, self._NegotiatedSize), self.write_size)
+			if write_size is None:
+				self.setPayloadSizes(self.read_size, self.read_size)
 
 	def __enter__(self):
 		return self
@@ -755,18 +1721,273 @@ class Session(object):
 
 	def setSession(self, session):
 		self.session = session
+		## Sessions to the same server, such as a hedge alternative, each get their own gauge
+		if session is not None and hasattr(self, "congestion"):
+			self.congestion.rename("%s:%d/%d" % (self.address + (session,)))
+
+	def setPayloadSizes(self, read_size, write_size):
+		"""Replaces the buffers, so once the session is in use only call it holding the lock"""
+		self.read_size = read_size
+		self.write_size = write_size
+		## A Read reply is 7 bytes of header, the extra byte lets us notice truncated datagrams
+		self.receive_size = max(1024, read_size + 8)
+		self.receive_buffer = bytearray(self.receive_size)
+		self.send_buffer = bytearray(max(1024, write_size + 7))
+
+	def _FindProbeFile(self, minimum):
+		directories = ["/"]
+		while len(directories) > 0:
+			directory = directories.pop(0)
+			for filename in self.ListDir(directory)[:32]:
+				path = fullPath(directory, filename)
+				reply, filestat = self.Stat(path)
+				if reply != 0:
+					continue
+				if stat.S_ISREG(filestat.mode) and filestat.size >= minimum:
+					return path, filestat.size
+				if stat.S_ISDIR(filestat.mode) and directory == "/":
+					directories.append(path)
+		return None, None
 
-	def _SendReceive(self, message):
-		#print "Session: %x, Sequence:%r, Message: %r " % (self.session if self.session is not None else -1, self.sequence, message)
-		message.setRetry(self.sequence).setSession(self.session)
-		self.sock.sendto(message.toWire(), self.address)
-		data, _ = self.sock.recvfrom(1024)
-		#print "Return: %r" % data[4]
-		self.sequence += 1
-		self.sequence %= 256
-		return data
+	def _NegotiatedSize(self):
+		with NegotiatedLock:
+			size = NegotiatedSizes.get(self.address)
+		if size is None:
+			size = self.ProbePayloadSize()
+			with NegotiatedLock:
+				NegotiatedSizes[self.address] = size
+		return size
+
+	def ProbePayloadSize(self, path = None, timeout = 2):
+		"""Finds the largest Read the server answers in full, using the biggest file near the root
+		unless a path is given. Servers that cap reads simply return less, those that can't
+		send such large datagrams either refuse or never answer, so we try smaller sizes"""
+		if path is None:
+			path, size = self._FindProbeFile(self.ProbeSizes[-1])
+		else:
+			reply, filestat = self.Stat(path)
+			size = filestat.size if reply == 0 else None
+		if path is None or size is None or size < self.ProbeSizes[-1]:
+			return self.read_size
+
+		reply, fd = self.Open(path, tnfs_flag.O_RDONLY)
+		if reply != 0:
+			return self.read_size
+		saved_timeout = self.timeout
+		self.timeout = timeout
+		try:
+			for candidate in self.ProbeSizes:
+				if candidate > size:
+					continue
+				self.setPayloadSizes(candidate, self.write_size)
+				try:
+					if self.LSeek(fd, 0, os.SEEK_SET) != 0:
+						break
+					reply, data, missing = self._ReadChunk(self.files[fd].server_handle, candidate)
+				except socket.timeout:
+					continue
+				if reply == 0 and missing == 0 and len(data) > self.DefaultPayload:
+					self.setPayloadSizes(len(data), self.write_size)
+					break
+				if reply == 0:
+					self.setPayloadSizes(self.DefaultPayload, self.write_size)
+					break
+			else:
+				self.setPayloadSizes(self.DefaultPayload, self.write_size)
+		finally:
+			self.timeout = saved_timeout
+			self.Close(fd)
+		return self.read_size
+
+	def EnableHedging(self, alternatives = (), fraction = 0.95):
+		"""Stat is hedged over the alternative sessions (replicas, or a second session to the
+		same server). ReadDir can't be moved to another session because the directory handle
+		only exists on this one, so it is hedged by retransmitting with the same sequence
+		number, which the server answers from its reply cache without reading another entry"""
+		self.hedge_fraction = fraction
+		self.alternatives = list(alternatives)
+		return self
+
+	def _Alternative(self):
+		candidates = [session for session in self.alternatives if session.session is not None]
+		if len(candidates) == 0:
+			return None
+		return min(candidates, key = lambda session: session.latency.average if session.latency.average is not None else self.timeout)
+
+	def _SendReceive(self, message, retransmit = False, cancelled = None, raw = False):
+		"""Sends a message and returns the reply datagram. With raw, the reply is left in
+		receive_buffer and only its length is returned, so the caller must hold the lock.
+		Setting cancelled abandons the request, even while it waits for the reply"""
+		if cancelled is not None and cancelled.is_set():
+			raise Cancelled()
+		with self.lock.holding(tnfs_priority.METADATA if message.command in MetadataCommands else tnfs_priority.FOREGROUND):
+			if cancelled is not None and cancelled.is_set():
+				raise Cancelled()
+			#print "Session: %x, Sequence:%r, Message: %r " % (self.session if self.session is not None else -1, self.sequence, message)
+			message.setRetry(self.sequence).setSession(self.session)
+			if hasattr(message, "packInto"):
+				try:
+					wire = memoryview(self.send_buffer)[:message.packInto(self.send_buffer)]
+				except ProtocolError:
+					## Too big for the buffer, such as a very long path
+					wire = message.toWire()
+			else:
+				wire = message.toWire()
+			reply = self.receive_buffer
+			started = time.time()
+			deadline = started + self.timeout
+			wait = self._RetransmitDelay()
+			retransmitted = False
+			hedging = retransmit and self.hedge_fraction is not None and len(self.latency.samples) >= 16
+			if hedging:
+				wait = self.latency.percentile(self.hedge_fraction)
+				metrics.increment("hedge.calls")
+			try:
+				self.congestion.pace()
+				self.sock.sendto(wire, self.address)
+				resend = time.time() + wait
+				while True:
+					now = time.time()
+					remaining = deadline - now
+					if remaining <= 0:
+						raise socket.timeout("timed out")
+					if cancelled is not None and cancelled.is_set():
+						## The reply may still come, so it must not match the next request
+						self.sequence = (self.sequence + 1) % 256
+						raise Cancelled()
+					## Also reached straight after a stale reply that arrived past the deadline
+					if now >= resend:
+						## Same sequence number, so the server answers from its reply cache if it already executed it
+						metrics.increment("hedge.sent" if hedging else "retransmits")
+						if not hedging:
+							self.congestion.onTimeout(wait)
+						self.congestion.pace()
+						self.sock.sendto(wire, self.address)
+						hedging = False
+						retransmitted = True
+						wait = min(wait * 2, self.timeout)
+						resend = time.time() + wait
+						continue
+					## A hedge contender looks in on its rival now and then
+					self.sock.settimeout(min(resend - now, remaining, self.CancelPoll if cancelled is not None else remaining))
+					try:
+						count, _ = self.sock.recvfrom_into(reply)
+					except socket.timeout:
+						continue
+					## Late replies to hedged or abandoned requests carry an older sequence number
+					if count >= 4 and reply[2] == self.sequence and reply[3] == message.command:
+						break
+					metrics.increment("stale_replies")
+			except socket.error:
+				self.latency.recordFailure()
+				raise
+			if not retransmitted:
+				self.latency.record(time.time() - started)
+			self.congestion.onSuccess()
+			#print "Return: %r" % reply[4]
+			self.sequence += 1
+			self.sequence %= 256
+			if message.command != Mount.TnfsCmd and count > 4 and reply[4] == EBADSESSION:
+				raise SessionLost("Server %s:%d dropped session %r" % (self.address + (self.session,)))
+			if raw:
+				return count
+			return memoryview(reply)[:count].tobytes()
+
+	def _RetransmitDelay(self):
+		p95 = self.latency.percentile(0.95)
+		return min(self.timeout, max(0.1, 2 * p95) if p95 is not None else 1.0)
+
+	def _Pipeline(self, messages, window = 16, resent = None):
+		"""Sends (key, message) pairs with up to window of them waiting for a reply, each under its
+		own sequence number, and yields (key, reply datagram) in the order the replies arrive.
+		A None instead of a pair means nothing more can be sent until another reply is in, so it
+		may only come while a request is waiting for its reply.
+
+		The session is held for the whole batch, so don't issue other requests on it from the
+		loop consuming the results. Unanswered requests are sent again, and the server may run
+		them twice: requests that aren't safe to repeat need a set as resent, which gets the
+		keys of the requests that were sent more than once"""
+		messages = iter(messages)
+		window = max(1, min(window, 128))
+		with self.lock.holding(tnfs_priority.METADATA):
+			pending = {}
+			## Timed out requests the shrunken window had no room to resend yet, oldest first
+			owed = []
+			def resend(sequence):
+				key, command, wire, sent, _ = pending[sequence]
+				metrics.increment("pipeline.retransmits")
+				self.congestion.pace()
+				self.sock.sendto(wire, self.address)
+				pending[sequence] = (key, command, wire, sent, True)
+				if resent is not None:
+					resent.add(key)
+
+			exhausted = False
+			while True:
+				## Someone else's turn: stop sending, and step aside once the replies are in
+				contended = self.lock.contended()
+				if contended and len(pending) == 0:
+					self.lock.yieldTurn()
+					contended = False
+				while len(owed) > 0 and len(pending) - len(owed) < min(window, self.congestion.allowed()):
+					resend(owed.pop(0))
+				while not exhausted and len(owed) == 0 and not contended and len(pending) < min(window, self.congestion.allowed()):
+					try:
+						item = next(messages)
+					except StopIteration:
+						exhausted = True
+						break
+					if item is None:
+						break
+					key, message = item
+					## Sequence numbers are only 8 bits, so skip those of requests still unanswered
+					while self.sequence in pending:
+						self.sequence = (self.sequence + 1) % 256
+					message.setRetry(self.sequence).setSession(self.session)
+					wire = message.toWire()
+					self.congestion.pace()
+					self.sock.sendto(wire, self.address)
+					pending[self.sequence] = (key, message.command, wire, time.time(), False)
+					self.sequence = (self.sequence + 1) % 256
+				if len(pending) == 0:
+					if exhausted:
+						break
+					continue
+
+				delay = self._RetransmitDelay()
+				self.sock.settimeout(delay)
+				try:
+					count, _ = self.sock.recvfrom_into(self.receive_buffer)
+					data = memoryview(self.receive_buffer)[:count].tobytes()
+				except socket.timeout:
+					if min(entry[3] for entry in pending.values()) + self.timeout < time.time():
+						self.latency.recordFailure()
+						raise
+					self.congestion.onTimeout(delay)
+					## Only resend what the shrunken window allows, the rest goes out as replies come in
+					overdue = sorted(pending, key = lambda sequence: pending[sequence][3])
+					allowed = min(window, self.congestion.allowed())
+					for sequence in overdue[:allowed]:
+						resend(sequence)
+					owed = overdue[allowed:]
+					continue
+
+				if len(data) < 4 or ord(data[2]) not in pending or pending[ord(data[2])][1] != ord(data[3]):
+					metrics.increment("stale_replies")
+					continue
+				if ord(data[2]) in owed:
+					owed.remove(ord(data[2]))
+				key, command, wire, sent, retransmitted = pending.pop(ord(data[2]))
+				## Like Karn's algorithm, a reply to a resent request says nothing about the round trip time
+				if not retransmitted:
+					self.latency.record(time.time() - sent)
+				self.congestion.onSuccess()
+				if len(data) > 4 and ord(data[4]) == EBADSESSION:
+					raise SessionLost("Server %s:%d dropped session %r" % (self.address + (self.session,)))
+				yield key, data
 
 	def Mount(self, path):
+		self.location = path
 		data = self._SendReceive(Mount().setLocation(path))
 		r = MountResponse().fromWire(data)
 		if r.reply == 0:
@@ -774,102 +1995,444 @@ class Session(object):
 		return r.reply, r.ver_maj, r.ver_min
 
 	def Umount(self):
+		self.StopRecovery()
 		data = self._SendReceive(Umount())
 		r = UmountResponse().fromWire(data)
 		self.setSession(None)
 		return r.reply
 
-	def OpenDir(self, path):
+	def _Track(self, table, tracked):
+		with self.lock:
+			handle = self.next_handle
+			self.next_handle += 1
+			table[handle] = tracked
+		return handle
+
+	def _Tracked(self, table, handle):
+		tracked = table.get(handle)
+		if tracked is None or tracked.server_handle is None:
+			return None
+		return tracked
+
+	def _Remount(self):
+		"""Mounts again and re-opens every tracked handle at its tracked position"""
+		saved_timeout = self.timeout
+		self.timeout = min(saved_timeout, self.recovery_timeout)
+		try:
+			reply, _, _ = self.Mount(self.location)
+			if reply != 0:
+				return False
+			self.generation += 1
+			for tracked in self.files.values():
+				reply, tracked.server_handle = self._Open(tracked.path, tracked.flags, tracked.mode)
+				if reply == 0 and self._LSeek(tracked.server_handle, tracked.offset, tracked.whence) != 0:
+					tracked.server_handle = None
+			for tracked in self.dirs.values():
+				reply, tracked.server_handle = self._OpenDir(tracked.path)
+				if reply == 0 and tracked.position is not None:
+					reply = self._SeekDir(tracked.server_handle, tracked.position)
+				for skipped in range(tracked.offset):
+					if reply != 0:
+						break
+					reply, _ = self._ReadDir(tracked.server_handle)
+		except socket.error:
+			return False
+		finally:
+			self.timeout = saved_timeout
+		metrics.increment("session.recoveries")
+		return True
+
+	def _Reconnect(self):
+		while not self.stop_recovery.wait(self.recovery_timeout):
+			with self.lock:
+				if self._Remount():
+					self.reconnecting = None
+					return
+
+	def Recover(self, generation):
+		"""Called after a request found the session gone (the server restarted, or stopped
+		answering). Mounts again and re-opens the tracked handles. If the server can't be reached,
+		a background thread keeps trying while requests fail straight away. Returns whether the
+		session is usable again"""
+		with self.lock:
+			if self.generation != generation:
+				return True
+			if not self.recover or self.reconnecting is not None:
+				return False
+			if self._Remount():
+				return True
+			self.reconnecting = threading.Thread(target = self._Reconnect)
+			self.reconnecting.daemon = True
+			self.reconnecting.start()
+			return False
+
+	def StopRecovery(self):
+		self.recover = False
+		self.stop_recovery.set()
+
+	def _OpenDir(self, path):
 		data = self._SendReceive(OpenDir().setPath(path))
 		r = OpenDirResponse().fromWire(data)
 		return r.reply, r.handle
 
-	def ReadDir(self, handle):
-		data = self._SendReceive(ReadDir().setHandle(handle))
+	@recoverable
+	def OpenDir(self, path):
+		reply, server_handle = self._OpenDir(path)
+		if reply != 0:
+			return reply, None
+		return reply, self._Track(self.dirs, TrackedHandle(path, server_handle))
+
+	def _ReadDir(self, server_handle):
+		data = self._SendReceive(ReadDir().setHandle(server_handle), retransmit = True)
 		r = ReadDirResponse().fromWire(data)
 		return r.reply, r.path
 
+	@recoverable
+	def ReadDir(self, handle):
+		tracked = self._Tracked(self.dirs, handle)
+		if tracked is None:
+			return errno.EBADF, None
+		reply, path = self._ReadDir(tracked.server_handle)
+		if reply == 0:
+			tracked.offset += 1
+		return reply, path
+
+	def _SeekDir(self, server_handle, position):
+		data = self._SendReceive(SeekDir().setHandle(server_handle).setPosition(position))
+		r = SeekDirResponse().fromWire(data)
+		return r.reply
+
+	@recoverable
+	def SeekDir(self, handle, position):
+		"""Moves a directory handle to a position returned earlier by TellDir"""
+		tracked = self._Tracked(self.dirs, handle)
+		if tracked is None:
+			return errno.EBADF
+		reply = self._SeekDir(tracked.server_handle, position)
+		if reply == 0:
+			tracked.position = position
+			tracked.offset = 0
+		return reply
+
+	@recoverable
+	def TellDir(self, handle):
+		tracked = self._Tracked(self.dirs, handle)
+		if tracked is None:
+			return errno.EBADF, None
+		data = self._SendReceive(TellDir().setHandle(tracked.server_handle))
+		r = TellDirResponse().fromWire(data)
+		return r.reply, r.position
+
+	@recoverable
 	def CloseDir(self, handle):
-		data = self._SendReceive(CloseDir().setHandle(handle))
+		tracked = self._Tracked(self.dirs, handle)
+		self.dirs.pop(handle, None)
+		if tracked is None:
+			return errno.EBADF
+		data = self._SendReceive(CloseDir().setHandle(tracked.server_handle))
 		r = CloseDirResponse().fromWire(data)
 		return r.reply
 
+	@changes
+	@recoverable
 	def MkDir(self, path):
 		data = self._SendReceive(MkDir().setPath(path))
 		r = MkDirResponse().fromWire(data)
 		return r.reply
 
+	@changes
+	@recoverable
 	def RmDir(self, path):
 		data = self._SendReceive(RmDir().setPath(path))
 		r = RmDirResponse().fromWire(data)
 		return r.reply
 
-	def Open(self, path, flags = 0, mode = 0):
+	def _Open(self, path, flags, mode):
 		data = self._SendReceive(Open().setPath(path).setFlags(flags).setMode(mode))
 		r = OpenResponse().fromWire(data)
 		return r.reply, r.fd
 
-	def Read(self, fd, size):
-		data_received = []
-		while size > 0:
-			data = self._SendReceive(Read().setFD(fd).setSize(size if size <= 512 else 512))
-			r = ReadResponse().fromWire(data)
-			if r.reply == 0:
-				data_received.append(r.data)
-				size -= len(r.data)
-			else:
-				break
-		data_received = "".join(data_received)
-		if (len(data_received) > 0):
-			return 0, "".join(data_received)
-		else:
-			return r.reply, None
+	@recoverable
+	def Open(self, path, flags = 0, mode = 0):
+		try:
+			reply, fd = self._Open(path, flags, mode)
+		finally:
+			if flags & (tnfs_flag.O_CREAT | tnfs_flag.O_TRUNC):
+				self._Changed()
+		if reply != 0:
+			return reply, None
+		## Re-opening after a recovery mustn't create or truncate the file again
+		reopen_flags = flags & ~(tnfs_flag.O_CREAT | tnfs_flag.O_TRUNC | tnfs_flag.O_EXCL)
+		return reply, self._Track(self.files, TrackedHandle(path, fd, reopen_flags, mode))
+
+	def _ReadChunk(self, fd, size):
+		"""A single Read message. Also returns how many of the bytes the server says it sent
+		didn't arrive, which happens when the reply was bigger than our receive buffer"""
+		data = self._SendReceive(Read().setFD(fd).setSize(size))
+		r = ReadResponse().fromWire(data)
+		if r.reply != 0:
+			return r.reply, None, 0
+		return r.reply, r.data, r.size - len(r.data)
+
+	@recoverable
+	def ReadInto(self, fd, target):
+		"""Reads up to len(target) bytes straight into a bytearray, or a memoryview of one.
+		Each reply is copied once, from the receive buffer into its place in target.
+		Returns (reply, bytes read)"""
+		tracked = self._Tracked(self.files, fd)
+		if tracked is None:
+			return errno.EBADF, 0
+		view = memoryview(target)
+		start = (tracked.whence, tracked.offset)
+		received = 0
+		reply = 0
+		try:
+			with self.lock:
+				while received < len(view):
+					if received > 0 and self.lock.contended():
+						self.lock.yieldTurn()
+					count = self._SendReceive(Read().setFD(tracked.server_handle).setSize(min(len(view) - received, self.read_size)), raw = True)
+					buffer = self.receive_buffer
+					if count < 5 or (buffer[4] == 0 and count < 7):
+						## Where that left the server's file position is unknown, so put it back where we think it is
+						self._LSeek(tracked.server_handle, tracked.offset, tracked.whence)
+						raise ProtocolError("Read reply of %d bytes is shorter than its header" % count)
+					reply = buffer[4]
+					if reply != 0:
+						break
+					size = struct.unpack_from("<H", buffer, 5)[0]
+					arrived = min(size, count - 7, len(view) - received)
+					view[received:received + arrived] = memoryview(buffer)[7:7 + arrived]
+					received += arrived
+					tracked.offset += arrived
+					if size > arrived:
+						## The server moved the file position past what we got, so step back and use smaller reads
+						self._LSeek(tracked.server_handle, arrived - size, os.SEEK_CUR)
+						self.setPayloadSizes(max(self.DefaultPayload, self.read_size / 2), self.write_size)
+					elif size == 0:
+						break
+		except (SessionLost, socket.timeout):
+			## Recovery re-opens the file where this call started, and the retry reads it all again
+			tracked.whence, tracked.offset = start
+			raise
+		if received > 0:
+			return 0, received
+		return reply, 0
 
+	def Read(self, fd, size):
+		data = bytearray(size)
+		reply, received = self.ReadInto(fd, data)
+		if received == 0:
+			return reply, None
+		del data[received:]
+		return 0, data
+
+	@changes
+	@recoverable
 	def Write(self, fd, data_to_send):
+		tracked = self._Tracked(self.files, fd)
+		if tracked is None:
+			return errno.EBADF, 0
+		view = memoryview(data_to_send)
+		start = (tracked.whence, tracked.offset)
 		written = 0
-		while written < len(data_to_send):
-			data = self._SendReceive(Write().setFD(fd).setData(data_to_send[written:written+512]))
-			r = WriteResponse().fromWire(data)
-			if r.reply != 0:
-				break
-			written += r.size
-		return r.reply, written
-
+		reply = 0
+		try:
+			## Held throughout so the buffers aren't resized under another request
+			with self.lock:
+				while written < len(view):
+					if written > 0 and self.lock.contended():
+						self.lock.yieldTurn()
+					chunk = view[written:written + self.write_size]
+					try:
+						data = self._SendReceive(Write().setFD(tracked.server_handle).setData(chunk))
+					except socket.timeout:
+						## Some servers drop messages bigger than they take instead of refusing them
+						if len(chunk) <= self.DefaultPayload:
+							raise
+						## In case it was written after all, the retry mustn't get its reply or land after it
+						self.sequence = (self.sequence + 1) % 256
+						self._LSeek(tracked.server_handle, tracked.offset, tracked.whence)
+						self.setPayloadSizes(self.read_size, self.DefaultPayload)
+						continue
+					r = WriteResponse().fromWire(data)
+					reply = r.reply
+					if r.reply != 0:
+						## Servers that can't take the bigger messages we guessed at refuse them, so retry with the safe size
+						if len(chunk) > self.DefaultPayload:
+							self.setPayloadSizes(self.read_size, self.DefaultPayload)
+							continue
+						break
+					if r.size == 0:
+						## Nothing was taken, sending the same chunk again would go on forever
+						break
+					if r.size < len(chunk) and self.write_size > self.DefaultPayload:
+						self.setPayloadSizes(self.read_size, max(self.DefaultPayload, r.size))
+					written += r.size
+					tracked.offset += r.size
+		except (SessionLost, socket.timeout):
+			tracked.whence, tracked.offset = start
+			raise
+		return reply, written
+
+	@recoverable
 	def Close(self, fd):
-		data = self._SendReceive(Close().setFD(fd))
+		tracked = self._Tracked(self.files, fd)
+		self.files.pop(fd, None)
+		if tracked is None:
+			return errno.EBADF
+		data = self._SendReceive(Close().setFD(tracked.server_handle))
 		r = CloseResponse().fromWire(data)
 		return r.reply
 
-	def Stat(self, path):
-		data = self._SendReceive(Stat().setPath(path))
+	def _Stat(self, path, cancelled = None):
+		data = self._SendReceive(Stat().setPath(path), cancelled = cancelled)
 		r = StatResponse().fromWire(data)
 		return r.reply, r
 
-	def LSeek(self, fd, offset, whence):
+	def Stat(self, path):
+		return self.stats.call(path, self._HedgedStat, path)
+
+	@recoverable
+	def _HedgedStat(self, path):
+		alternative = self._Alternative() if self.hedge_fraction is not None else None
+		if alternative is None:
+			return self._Stat(path)
+		return hedgedCall(self.latency, self.hedge_fraction, lambda settled: self._Stat(path, settled), lambda settled: alternative._Stat(path, settled))
+
+	def StatMany(self, paths, window = 16):
+		"""Pipelined Stat of many paths. Yields (path, reply, stat) as the replies arrive, which
+		is not necessarily the order of paths"""
+		paths = list(paths)
+		done = set()
+		for attempt in range(2):
+			generation = self.generation
+			messages = ((index, Stat().setPath(path)) for index, path in enumerate(paths) if index not in done)
+			try:
+				for index, data in self._Pipeline(messages, window):
+					r = StatResponse().fromWire(data)
+					done.add(index)
+					yield paths[index], r.reply, r
+				return
+			except (SessionLost, socket.timeout):
+				if attempt > 0 or not self.Recover(generation):
+					raise
+
+	def MutateMany(self, operations, window = 16):
+		"""Pipelined metadata changes, see MutationMessages. Changes go out together unless
+		mutationDependencies says one has to wait for another. Yields (number, reply) as the
+		replies arrive, number being the change's position in operations"""
+		operations = list(operations)
+		for operation in operations:
+			if operation[0] not in MutationMessages:
+				raise ValueError("Unknown change %r" % (operation,))
+		dependencies = mutationDependencies(operations)
+		waiting = [len(earlier) for earlier in dependencies]
+		dependents = [[] for operation in operations]
+		for number, earlier in enumerate(dependencies):
+			for other in earlier:
+				dependents[other].append(number)
+		done = set()
+		## Changes that may have been carried out already, and renames to check once the batch is over
+		repeated = set()
+		unsure = []
+
+		for attempt in range(2):
+			generation = self.generation
+			ready = collections.deque(number for number in range(len(operations)) if number not in done and waiting[number] == 0)
+			unsent = [len(operations) - len(done)]
+			def messages():
+				while unsent[0] > 0:
+					if len(ready) == 0:
+						yield None
+						continue
+					number = ready.popleft()
+					unsent[0] -= 1
+					yield number, MutationMessages[operations[number][0]](*operations[number][1:])
+			resent = set()
+			try:
+				for number, data in self._Pipeline(messages(), window, resent):
+					reply = ord(data[4]) if len(data) > 4 else errno.EIO
+					kind = operations[number][0]
+					done.add(number)
+					for other in dependents[number]:
+						waiting[other] -= 1
+						if waiting[other] == 0:
+							ready.append(other)
+					if reply != 0 and (number in resent or number in repeated):
+						if reply == AlreadyDone.get(kind):
+							reply = 0
+						elif kind == "rename" and reply == errno.ENOENT:
+							unsure.append(number)
+							continue
+					self._Changed()
+					yield number, reply
+				break
+			except (SessionLost, socket.timeout):
+				self._Changed()
+				if attempt > 0 or not self.Recover(generation):
+					raise
+				repeated.update(number for number in range(len(operations)) if number not in done)
+		self._Changed()
+
+		## A rename sent twice fails the second time if the first one worked
+		for number in unsure:
+			source, destination = operations[number][1:]
+			moved = self.Stat(source)[0] != 0 and self.Stat(destination)[0] == 0
+			yield number, 0 if moved else errno.ENOENT
+
+	def _LSeek(self, fd, offset, whence):
 		data = self._SendReceive(LSeek().setFD(fd).setSeekPosition(offset).setSeekType(whence))
 		r = LSeekResponse().fromWire(data)
 		return r.reply
 
+	@recoverable
+	def LSeek(self, fd, offset, whence):
+		tracked = self._Tracked(self.files, fd)
+		if tracked is None:
+			return errno.EBADF
+		reply = self._LSeek(tracked.server_handle, offset, whence)
+		if reply == 0:
+			if whence == os.SEEK_CUR:
+				tracked.offset += offset
+			else:
+				tracked.whence, tracked.offset = whence, offset
+		return reply
+
+	def _Changed(self):
+		"""Stats and listings already in flight may have missed a change made on this session.
+		Called once the change is done, so no call started before then is joined after it"""
+		self.stats.forget()
+		self.listings.forget()
+
+	@changes
+	@recoverable
 	def Unlink(self, path):
 		data = self._SendReceive(Unlink().setPath(path))
 		r = UnlinkResponse().fromWire(data)
 		return r.reply
 
+	@changes
+	@recoverable
 	def Rename(self, source, destination):
 		data = self._SendReceive(Rename().setSourcePath(source).setDestinationPath(destination))
 		r = RenameResponse().fromWire(data)
 		return r.reply
 
+	@changes
+	@recoverable
 	def ChMod(self, path, mode):
 		data = self._SendReceive(ChMod().setPath(path).setMode(mode))
 		r = ChModResponse().fromWire(data)
 		return r.reply
 
+	@recoverable
 	def GetFilesystemSize(self):
 		data = self._SendReceive(Size())
 		r = SizeResponse().fromWire(data)
 		return r.reply, r.size
 
+	@recoverable
 	def GetFilesystemFree(self):
 		data = self._SendReceive(Free())
 		r = FreeResponse().fromWire(data)
@@ -877,6 +2440,9 @@ class Session(object):
 
 	#----------------------------------------------#
 	def ListDir(self, path):
+		return list(self.listings.call(path, self._ListDir, path))
+
+	def _ListDir(self, path):
 		contents = []
 		reply, handle = self.OpenDir(path)
 		while reply == 0:
@@ -889,16 +2455,16 @@ class Session(object):
 		return contents
 
 	def GetFile(self, path):
-		data = []
+		data = bytearray()
 		reply, fd = self.Open(path)
 		if fd is None:
 			return None
 		while reply == 0:
-			reply, chunk = self.Read(fd, 4096)
+			reply, chunk = self.Read(fd, max(4096, self.read_size))
 			if reply == 0:
-				data.append(chunk)
+				data += chunk
 		self.Close(fd)
-		return "".join(data)
+		return data
 
 	def PutFile(self, path, data):
 		reply, fd = self.Open(path, tnfs_flag.O_WRONLY | tnfs_flag.O_CREAT | tnfs_flag.O_TRUNC, 0600)
@@ -906,19 +2472,316 @@ class Session(object):
 			print "Access denied"
 			return
 		pos = 0
+		chunk_size = max(4096, self.write_size)
+		view = memoryview(data)
 		while pos < len(data):
-			self.Write(fd, data[pos:pos + 4096])
-			pos += 4096
+			self.Write(fd, view[pos:pos + chunk_size])
+			pos += chunk_size
 		self.Close(fd)
 
+class DirectoryCursor(object):
+	"""Reads a directory one entry at a time and can be moved to any entry number. The server
+	position of every MarkEvery'th entry is kept in marks (shared by the cursors of the same
+	directory), so a seek only reads through the entries after the nearest mark.
+
+	The last entry read can be pushed back with seek(offset - 1), which is what a FUSE readdir
+	continuation asks for when the kernel buffer filled up on that entry."""
+	MarkEvery = 256
+
+	def __init__(self, session, path, marks = None):
+		self.session = session
+		self.path = path
+		self.marks = marks if marks is not None else {}
+		self.handle = None
+		self.offset = 0
+		self.last = None
+		self.pushed = None
+		self.finished = False
+		self.names = []
+		self.used = time.time()
+
+	def open(self):
+		self.close()
+		reply, self.handle = self.session.OpenDir(self.path)
+		self.offset = 0
+		self.last = self.pushed = None
+		self.finished = reply != 0
+		return reply
+
+	def close(self):
+		if self.handle is not None:
+			try:
+				self.session.CloseDir(self.handle)
+			except socket.error:
+				pass
+			self.handle = None
+		self.finished = True
+
+	def _mark(self):
+		if self.offset % self.MarkEvery != 0 or self.offset in self.marks:
+			return
+		reply, position = self.session.TellDir(self.handle)
+		if reply == 0:
+			self.marks[self.offset] = position
+		else:
+			## Server without TELLDIR, stop asking
+			self.MarkEvery = sys.maxint
+
+	def next(self):
+		"""The name of the next entry, or None at the end of the directory"""
+		self.used = time.time()
+		if self.pushed is not None:
+			name, self.pushed = self.pushed, None
+		else:
+			if self.finished:
+				return None
+			if self.offset > 0:
+				self._mark()
+			reply, name = self.session.ReadDir(self.handle)
+			if reply != 0:
+				self.finished = True
+				return None
+			if self.names is not None:
+				self.names.append(name)
+		self.last = name
+		self.offset += 1
+		return name
+
+	def seek(self, offset):
+		"""Moves to an entry number, so the next call to next() returns that entry"""
+		self.used = time.time()
+		if self.handle is None and not self.finished:
+			self.open()
+		if offset == self.offset:
+			return
+		if offset == self.offset - 1 and self.last is not None and self.pushed is None:
+			self.pushed, self.last = self.last, None
+			self.offset -= 1
+			return
+		if self.handle is None:
+			self.open()
+		start = max([mark for mark in self.marks if mark <= offset] or [0])
+		if offset < self.offset or start > self.offset:
+			self.names = None
+			if start > 0 and self.session.SeekDir(self.handle, self.marks[start]) == 0:
+				self.offset = start
+				self.last = self.pushed = None
+				self.finished = False
+			else:
+				self.marks.clear()
+				self.open()
+		while self.offset < offset and self.next() is not None:
+			pass
+
+class ReplicaSet(object):
+	"""A primary TNFS server plus any number of mirrors of the same tree.
+
+	Metadata and writes go to the primary (every other attribute is forwarded to it, so a
+	ReplicaSet can stand in for a Session). ReadAt() stripes file reads by block across all
+	healthy servers, the primary included. A server is left out of the stripe for a while
+	when it fails or when its live latency is much worse than the fastest one."""
+	def __init__(self, primary, replicas = (), block_size = 4096, replica_timeout = 5, slow_factor = 4.0, penalty = 30, **options):
+		self.primary = Session(primary, **options)
+		self.servers = [self.primary]
+		for address in replicas:
+			try:
+				self.servers.append(Session(address, replica_timeout, **options))
+			except socket.error, e:
+				print "Replica %s:%d unavailable: %s" % (address[0], address[1], e)
+		self.block_size = block_size
+		self.block_latency = dict((server, LatencyTracker()) for server in self.servers)
+		self.hedge_fraction = None
+		self.slow_factor = slow_factor
+		self.penalty = penalty
+		self.excluded = {}
+		self.handles = {}
+		self.open_count = {}
+		self.lock = threading.RLock()
+		self.block_flights = SingleFlight("blocks")
+
+	def __getattr__(self, name):
+		return getattr(self.primary, name)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		for server in self.servers:
+			server.__exit__(ex_type, ex_value, traceback)
+
+	def EnableHedging(self, fraction = 0.95):
+		"""Stat is hedged to the fastest replica, and a block read to another healthy server"""
+		self.hedge_fraction = fraction
+		self.primary.EnableHedging(self.servers[1:], fraction)
+		return self
+
+	def Exclude(self, server):
+		if server is not self.primary:
+			with self.lock:
+				self.excluded[server] = time.time() + self.penalty
+
+	def Healthy(self):
+		with self.lock:
+			now = time.time()
+			for server, until in self.excluded.items():
+				if until <= now:
+					del self.excluded[server]
+					server.latency.reset()
+
+			candidates = [server for server in self.servers if server not in self.excluded]
+			averages = [server.latency.average for server in candidates if server.latency.average is not None]
+			if len(averages) > 0:
+				limit = min(averages) * self.slow_factor
+				for server in candidates:
+					if server.latency.average is not None and server.latency.average > limit:
+						self.Exclude(server)
+			return [server for server in candidates if server not in self.excluded]
+
+	def Write(self, fd, data_to_send):
+		try:
+			return self.primary.Write(fd, data_to_send)
+		finally:
+			## Block reads already in flight may have missed what was written
+			self.block_flights.forget()
+
+	def OpenStriped(self, path):
+		with self.lock:
+			self.open_count[path] = self.open_count.get(path, 0) + 1
+
+	def CloseStriped(self, path):
+		with self.lock:
+			self.open_count[path] -= 1
+			if self.open_count[path] > 0:
+				return
+			del self.open_count[path]
+			handles = [(server, fd) for (server, handle_path), fd in self.handles.items() if handle_path == path]
+			for server, fd in handles:
+				del self.handles[(server, path)]
+		for server, fd in handles:
+			try:
+				server.Close(fd)
+			except socket.error:
+				pass
+
+	def _Handle(self, server, path):
+		## Callers hold server.lock, so only one thread opens a path on each server
+		with self.lock:
+			fd = self.handles.get((server, path))
+		if fd is None:
+			reply, fd = server.Open(path, tnfs_flag.O_RDONLY)
+			if reply != 0:
+				raise IOError(reply, os.strerror(reply))
+			with self.lock:
+				self.handles[(server, path)] = fd
+		return fd
+
+	def _ReadBlock(self, server, path, offset, target, cancelled = None):
+		started = time.time()
+		with server.lock:
+			if cancelled is not None and cancelled.is_set():
+				raise Cancelled()
+			fd = self._Handle(server, path)
+			reply = server.LSeek(fd, offset, os.SEEK_SET)
+			if reply != 0:
+				raise IOError(reply, os.strerror(reply))
+			reply, count = server.ReadInto(fd, target)
+		self.block_latency[server].record(time.time() - started)
+		return count
+
+	def _HedgedReadBlock(self, server, path, offset, target):
+		alternatives = [other for other in self.Healthy() if other is not server]
+		if self.hedge_fraction is None or len(alternatives) == 0:
+			return self._ReadBlock(server, path, offset, target)
+		other = min(alternatives, key = lambda other: self.block_latency[other].average or 0)
+
+		## The loser may still be reading when we return, so each side gets its own buffer
+		def contender(candidate):
+			def read(settled):
+				block = bytearray(len(target))
+				return self._ReadBlock(candidate, path, offset, block, settled), block
+			return read
+		count, block = hedgedCall(self.block_latency[server], self.hedge_fraction, contender(server), contender(other))
+		target[:count] = memoryview(block)[:count]
+		return count
+
+	def _SharedReadBlock(self, server, path, offset, target):
+		"""Readers of the same block at the same time share one read, the others copy its data"""
+		count, block = self.block_flights.call((path, offset, len(target)), lambda: (self._HedgedReadBlock(server, path, offset, target), target))
+		if block is not target:
+			target[:count] = block[:count]
+		return count
+
+	def _ReadBlocks(self, server, path, blocks, results):
+		for offset, target in blocks:
+			try:
+				results[offset] = self._SharedReadBlock(server, path, offset, target)
+			except (socket.error, IOError):
+				self.Exclude(server)
+				return
+
+	def ReadAt(self, path, offset, length):
+		"""Reads length bytes at offset into a single bytearray, each block landing directly in
+		its place"""
+		data = bytearray(length)
+		view = memoryview(data)
+		blocks = []
+		position = offset
+		while position < offset + length:
+			size = min(self.block_size - position % self.block_size, offset + length - position)
+			blocks.append((position, view[position - offset:position - offset + size]))
+			position += size
+
+		servers = self.Healthy()
+		results = {}
+		stripes = [(server, blocks[index::len(servers)]) for index, server in enumerate(servers) if index < len(blocks)]
+		if len(stripes) == 1:
+			self._ReadBlocks(stripes[0][0], path, stripes[0][1], results)
+		else:
+			workers = [threading.Thread(target = self._ReadBlocks, args = (server, path, assigned, results)) for server, assigned in stripes]
+			for worker in workers:
+				worker.start()
+			for worker in workers:
+				worker.join()
+
+		received = 0
+		for position, target in blocks:
+			if position not in results:
+				try:
+					results[position] = self._ReadBlock(self.primary, path, position, target)
+				except IOError, e:
+					return e.errno, None
+			received += results[position]
+			if results[position] < len(target):
+				break
+		## Only short at the end of the file. Block views may still be alive, so copy rather than resize
+		if received < length:
+			return 0, data[:received]
+		return 0, data
+
 if __name__ == "__main__":
-	#RunTests()
+	if len(sys.argv) > 1 and sys.argv[1] == "--test":
+		RunTests(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+		sys.exit(0)
+	if len(sys.argv) > 1 and sys.argv[1] == "--bench":
+		slower = RunBenchmarks(save = "--save" in sys.argv)
+		sys.exit(1 if len(slower) > 0 and "--save" not in sys.argv else 0)
+
+	daemon = None
+	if len(sys.argv) > 2 and sys.argv[1] == "--daemon":
+		daemon = sys.argv[2]
+		del sys.argv[1:3]
 
 	address = (sys.argv[1] if len(sys.argv) > 1 else 'vexed4.alioth.net', int(sys.argv[2]) if len(sys.argv) > 2 else 16384)
 	print "Connecting to %s:%d..." % address
 	command = ["ls"]
 	cwd = "/"
-	with Session(address) as S:
+	if daemon is not None:
+		import tnfs_cached
+		S = tnfs_cached.CachedSession(address, daemon)
+	else:
+		S = Session(address)
+	names = None
+	with S:
 		print "Remote server is version", S.version
 		while True:
 			if len(command) == 0:
@@ -945,8 +2808,11 @@ if __name__ == "__main__":
 					listing_format = "{0:^15s} {1:0>5o} {2:>15d} {3:>5d} {4:>5d} {5}"
 					listing_header = "{0:^15s} {1: ^5s} {2:^15s} {3:>5s} {4:>5s} {5}".format("TYPE", "PERM", "SIZE", "USER", "GROUP", "NAME")
 					listing.append(listing_header)
+					filestats = dict((filename, filestat) for filename, _, filestat in S.StatMany([fullPath(path, filename) for filename in files]))
 					for filename in files:
-						_, filestat = S.Stat(fullPath(path, filename))
+						filestat = filestats[fullPath(path, filename)]
+						if filestat.reply != 0:
+							continue
 						if stat.S_ISREG(filestat.mode):
 							filetype = "file"
 						elif stat.S_ISDIR(filestat.mode):
@@ -983,6 +2849,45 @@ if __name__ == "__main__":
 					S.RmDir(path)
 				else:
 					print "Syntax: rmdir <path>"
+			elif command[0] == "mrm" or command[0] == "mmkdir":
+				recursive = command[0] == "mrm" and "-r" in command
+				paths = [fullPath(cwd, path) for path in command[1:] if not (recursive and path == "-r")]
+				if len(paths) == 0:
+					print "Syntax: mrm [-r] <path>... or mmkdir <path>..."
+				else:
+					started = time.time()
+					if command[0] == "mmkdir":
+						operations = [("mkdir", path) for path in paths]
+					else:
+						operations = removalPlan(S, paths, recursive)
+					failed = 0
+					for number, reply in S.MutateMany(operations):
+						if reply != 0:
+							failed += 1
+							print "    %s %s: %s" % (operations[number][0], operations[number][1], os.strerror(reply))
+					print "%d changes, %d failed in %.1f ms" % (len(operations), failed, (time.time() - started) * 1000)
+			elif command[0] == "find" or command[0] == "reindex":
+				import tnfs_cache, tnfs_index
+				names_file = tnfs_cache.cachePath(address, "names")
+				if names is None:
+					names = tnfs_index.NameIndex()
+					if not names.loadFrom(names_file):
+						command = ["reindex"] + command
+				if command[0] == "reindex":
+					print "Indexing the names on the server..."
+					listed = tnfs_index.Crawler(S, names, names_file).crawl()
+					print "Listed %d directories, %d names indexed" % (listed, len(names))
+					command.pop(0)
+				if len(command) == 0:
+					pass
+				elif len(command) == 2:
+					started = time.time()
+					found = names.search(command[1])
+					for path in found:
+						print "    " + path
+					print "%d found in %.1f ms" % (len(found), (time.time() - started) * 1000)
+				else:
+					print "Syntax: find <name or glob>"
 			elif command[0] == "get":
 				if len(command) in (2, 3):
 					print "Downloading '%s'" % command[1]
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2012 Radu Cristescu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import re
+import stat
+import time
+import socket
+import marshal
+import fnmatch
+import threading
+
+from tnfs_client import fullPath, metrics, requestPriority, tnfs_priority
+
+def trigrams(text):
+	return set(text[i:i + 3] for i in range(len(text) - 2))
+
+class NameIndex(object):
+	"""Names of every file and directory in the remote tree, searchable without the network.
+	Names are matched case insensitively, either as a substring or as a glob the way find -iname
+	does, and candidates are narrowed down with a trigram index before matching.
+
+	The tree is kept as each directory's {name: is_directory} with its modification time, which
+	is also what gets saved."""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.children = {}
+		self.mtimes = {}
+		self.ids = {}
+		self.paths = []
+		self.free = []
+		self.trigrams = {}
+
+	def __len__(self):
+		return len(self.ids)
+
+	def _add(self, path):
+		number = self.free.pop() if len(self.free) > 0 else len(self.paths)
+		if number == len(self.paths):
+			self.paths.append(path)
+		else:
+			self.paths[number] = path
+		self.ids[path] = number
+		for gram in trigrams(os.path.basename(path).lower()):
+			self.trigrams.setdefault(gram, set()).add(number)
+
+	def _remove(self, path):
+		number = self.ids.pop(path)
+		self.paths[number] = None
+		self.free.append(number)
+		for gram in trigrams(os.path.basename(path).lower()):
+			self.trigrams[gram].discard(number)
+		for name in self.children.pop(path, {}):
+			self._remove(fullPath(path, name))
+		self.mtimes.pop(path, None)
+
+	def setDirectory(self, path, entries, mtime):
+		"""Replaces what is known about a directory with a fresh listing, {name: is_directory}"""
+		with self.lock:
+			old = self.children.get(path, {})
+			for name, is_directory in old.items():
+				if entries.get(name) != is_directory:
+					self._remove(fullPath(path, name))
+			for name in entries:
+				if fullPath(path, name) not in self.ids:
+					self._add(fullPath(path, name))
+			self.children[path] = dict(entries)
+			self.mtimes[path] = mtime
+
+	def removeDirectory(self, path):
+		with self.lock:
+			if path in self.ids:
+				parent = os.path.dirname(path)
+				self.children.get(parent, {}).pop(os.path.basename(path), None)
+				self._remove(path)
+			else:
+				self.children.pop(path, None)
+				self.mtimes.pop(path, None)
+
+	def directories(self):
+		"""{path: modification time} of the directories listed so far. Directories found but
+		not listed yet, because a crawl was stopped, have None"""
+		with self.lock:
+			known = dict(self.mtimes)
+			for path, entries in self.children.items():
+				for name, is_directory in entries.items():
+					if is_directory and fullPath(path, name) not in known:
+						known[fullPath(path, name)] = None
+		return known
+
+	def isDirectory(self, path):
+		with self.lock:
+			return self.children.get(os.path.dirname(path), {}).get(os.path.basename(path))
+
+	def search(self, pattern, limit = None):
+		"""Sorted paths whose name contains pattern, or matches it if it is a glob"""
+		pattern = pattern.lower()
+		if any(c in pattern for c in "*?["):
+			literals = re.split(r"\[[^\]]*\]|[*?]", pattern)
+			match = lambda name: fnmatch.fnmatchcase(name, pattern)
+		else:
+			literals = [pattern]
+			match = lambda name: pattern in name
+		started = time.time()
+		with self.lock:
+			candidates = None
+			for literal in literals:
+				for gram in trigrams(literal):
+					found = self.trigrams.get(gram, set())
+					candidates = set(found) if candidates is None else candidates & found
+			if candidates is None:
+				candidates = self.ids.values()
+			results = [self.paths[number] for number in candidates if match(os.path.basename(self.paths[number]).lower())]
+		results.sort()
+		metrics.increment("search.queries")
+		metrics.set("search.last_ms", int((time.time() - started) * 1000))
+		return results[:limit] if limit is not None else results
+
+	def save(self, filename):
+		with self.lock:
+			data = marshal.dumps((self.mtimes, self.children))
+		temporary = "%s.%d.tmp" % (filename, os.getpid())
+		with open(temporary, "wb") as f:
+			f.write(data)
+		os.rename(temporary, filename)
+
+	def loadFrom(self, filename):
+		"""Replaces the contents with the index saved in filename. Returns False, leaving the
+		contents alone, if there isn't a usable one"""
+		try:
+			with open(filename, "rb") as f:
+				mtimes, children = marshal.loads(f.read())
+		except (IOError, EOFError, ValueError, TypeError):
+			return False
+		loaded = NameIndex()
+		for path in children:
+			for name in children[path]:
+				loaded._add(fullPath(path, name))
+		with self.lock:
+			self.mtimes, self.children = mtimes, children
+			self.ids, self.paths, self.free, self.trigrams = loaded.ids, loaded.paths, loaded.free, loaded.trigrams
+		metrics.set("search.names", len(self.ids))
+		return True
+
+class Crawler(object):
+	"""Fills a NameIndex by walking the remote tree, at most rate directories per second.
+
+	A refresh Stats every known directory in one pipelined pass, and only lists again the
+	ones whose modification time changed, plus any new directories found that way. Started as
+	a thread, it first loads the saved index and then crawls every interval seconds, or never if
+	interval is None."""
+	def __init__(self, session, index, filename = None, interval = 1800, rate = None):
+		self.session = session
+		self.index = index
+		self.filename = filename
+		self.interval = interval
+		self.rate = rate
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+
+	def run(self):
+		if self.filename is not None:
+			self.index.loadFrom(self.filename)
+		while self.interval is not None and not self.stopped.is_set():
+			try:
+				with requestPriority(tnfs_priority.BULK, "crawler"):
+					self.crawl()
+			except (socket.error, IOError):
+				metrics.increment("search.crawl_errors")
+			self.stopped.wait(self.interval)
+
+	def crawl(self):
+		"""One pass over the tree, returns how many directories were listed"""
+		known = self.index.directories()
+		pending = []
+		if "/" not in known:
+			reply, attributes = self.session.Stat("/")
+			pending.append(("/", attributes.mtime if reply == 0 else 0))
+		for path, reply, attributes in self.session.StatMany(known):
+			if reply != 0:
+				self.index.removeDirectory(path)
+			elif attributes.mtime != known[path]:
+				pending.append((path, attributes.mtime))
+
+		listed = 0
+		while len(pending) > 0 and not self.stopped.is_set():
+			path, mtime = pending.pop()
+			entries = {}
+			for child, reply, attributes in self.session.StatMany([fullPath(path, name) for name in self.session.ListDir(path)]):
+				if reply != 0:
+					continue
+				entries[os.path.basename(child)] = stat.S_ISDIR(attributes.mode)
+				if stat.S_ISDIR(attributes.mode) and known.get(child) != attributes.mtime:
+					pending.append((child, attributes.mtime))
+			self.index.setDirectory(path, entries, mtime)
+			listed += 1
+			if self.rate:
+				self.stopped.wait(1.0 / self.rate)
+
+		metrics.increment("search.crawls")
+		metrics.increment("search.directories_listed", listed)
+		metrics.set("search.names", len(self.index))
+		if self.filename is not None:
+			self.index.save(self.filename)
+		return listed
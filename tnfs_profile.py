@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2012 Radu Cristescu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+
+import os
+import re
+import sys
+import signal
+import linecache
+import threading
+import collections
+
+from tnfs_client import metrics
+
+## Methods of the file system classes, by the name a sample is tagged with
+FuseOperations = {
+	"getattr": "getattr", "readdir": "readdir", "readlink": "readlink", "unlink": "unlink", "rename": "rename",
+	"mkdir": "mkdir", "rmdir": "rmdir", "truncate": "truncate", "__init__": "open", "read": "read", "write": "write", "release": "release", "flush": "flush",
+}
+
+## Lines blocking in the acquire of a lock written in C, which leaves no frame of its own
+LockLine = re.compile(r"\.acquire\(|^\s*with\b[^:]*\b\w*(lock|condition)\s*:", re.IGNORECASE)
+
+class SamplingProfiler(object):
+	"""Looks at the stack of every other thread each interval seconds while running, and counts
+	the stacks seen. Nothing is hooked into the code being profiled, so it costs nothing when
+	stopped.
+
+	Stacks are written collapsed, one "frame;frame;... count" line each, as flamegraph.pl and
+	speedscope read them. The outermost frames tag the sample with the FUSE operation and the
+	TNFS command being waited for, and the innermost says when the thread is blocked on the
+	network or on a lock."""
+	def __init__(self, interval = 0.005):
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.stacks = collections.Counter()
+		self.samples = 0
+		self.stopped = threading.Event()
+		self.thread = None
+		## (filename, line) -> what a thread stopped on that line is waiting for
+		self.waits = {}
+
+	@property
+	def running(self):
+		return self.thread is not None
+
+	def start(self):
+		if self.thread is not None:
+			return self
+		self.stopped.clear()
+		self.thread = threading.Thread(target = self.run, name = "tnfs-profiler")
+		self.thread.daemon = True
+		self.thread.start()
+		metrics.set("profile.running", 1)
+		return self
+
+	def stop(self):
+		if self.thread is None:
+			return
+		self.stopped.set()
+		self.thread.join()
+		self.thread = None
+		metrics.set("profile.running", 0)
+
+	def reset(self):
+		with self.lock:
+			self.stacks.clear()
+			self.samples = 0
+
+	def command(self, text):
+		"""What writing to /.tnfs/profile does: start (or 1), stop (or 0), or reset"""
+		text = text.strip().lower()
+		if text in ("start", "1", "on"):
+			self.start()
+		elif text in ("stop", "0", "off"):
+			self.stop()
+		elif text == "reset":
+			self.reset()
+		else:
+			raise ValueError("Unknown profiler command %r" % text)
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.sample()
+
+	def sample(self):
+		names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+		own = threading.current_thread().ident
+		stacks = [self.collapse(frame, names.get(ident, "thread")) for ident, frame in sys._current_frames().items() if ident != own]
+		with self.lock:
+			self.stacks.update(stacks)
+			self.samples += 1
+		metrics.increment("profile.samples")
+
+	def _waiting(self, frame):
+		key = (frame.f_code.co_filename, frame.f_lineno)
+		state = self.waits.get(key)
+		if state is None:
+			line = linecache.getline(*key)
+			if "recv" in line or "select" in line:
+				state = "[network]"
+			elif frame.f_code.co_name in ("wait", "acquire") and os.path.basename(key[0]).startswith("threading"):
+				state = "[lock wait]"
+			elif LockLine.search(line):
+				state = "[lock wait]"
+			elif "sleep" in line:
+				state = "[sleep]"
+			else:
+				state = ""
+			self.waits[key] = state
+		return state
+
+	def collapse(self, frame, thread_name):
+		state = self._waiting(frame)
+		frames = []
+		operation = command = None
+		while frame is not None:
+			code = frame.f_code
+			filename = os.path.basename(code.co_filename)
+			frames.append("%s:%s" % (filename, code.co_name))
+			if filename.startswith("tnfs-fuse") and code.co_name in FuseOperations:
+				operation = FuseOperations[code.co_name]
+			elif code.co_name == "_SendReceive" and command is None:
+				message = frame.f_locals.get("message")
+				command = message.__class__.__name__ if message is not None else None
+			elif code.co_name == "_Pipeline" and command is None:
+				command = "Pipeline"
+			frame = frame.f_back
+		frames.reverse()
+		if state:
+			frames.append(state)
+		tags = ["fuse:" + operation if operation is not None else "thread:" + thread_name]
+		if command is not None:
+			tags.append("tnfs:" + command)
+		return ";".join(tags + frames)
+
+	def format(self):
+		with self.lock:
+			stacks = sorted(self.stacks.items())
+		return "".join("%s %d\n" % item for item in stacks)
+
+	def save(self, filename):
+		with open(filename, "w") as f:
+			f.write(self.format())
+
+def installSignal(profiler, filename, signum = signal.SIGUSR2):
+	"""Makes signum switch the profiler on and off. Switching it off writes the stacks to
+	filename and starts the next run afresh. Python only runs the handler on the main thread,
+	so this is no use while it is blocked outside Python, as in a threaded FUSE loop"""
+	def toggle(signum, frame):
+		if not profiler.running:
+			profiler.reset()
+			profiler.start()
+			print "Profiling every %gs until the next signal %d" % (profiler.interval, signum)
+			return
+		profiler.stop()
+		profiler.save(filename)
+		print "Profile of %d samples written to %s" % (profiler.samples, filename)
+	signal.signal(signum, toggle)
@@ -0,0 +1,551 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2012 Radu Cristescu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+
+import os
+import imp
+import sys
+import stat
+import time
+import heapq
+import errno
+import random
+import select
+import shutil
+import socket
+import hashlib
+import optparse
+import tempfile
+import threading
+import contextlib
+import collections
+
+import tnfs_client
+from tnfs_client import metrics, tnfs_flag, Commands, Responses, EBADSESSION, TnfsEOF, ProtocolError
+
+class StandInServer(object):
+	"""A TNFS server sharing a local directory, standing in for tnfsd. Like tnfsd it answers one
+	datagram at a time, and keeps the last reply of each session to answer retransmits with"""
+	def __init__(self, root, max_payload = 512, address = ("127.0.0.1", 0)):
+		self.root = root
+		self.max_payload = max_payload
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(address)
+		self.address = self.sock.getsockname()
+		self.sessions = {}
+		self.next_session = 0x100
+		self.running = False
+		self.thread = None
+
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target = self.run, name = "tnfs-stand-in")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.running = False
+		self.thread.join()
+		self.sock.close()
+		for session in self.sessions.values():
+			for fd in session["files"].values():
+				os.close(fd)
+
+	def run(self):
+		while self.running:
+			if not select.select([self.sock], [], [], 0.1)[0]:
+				continue
+			data, client = self.sock.recvfrom(65536)
+			reply = self.handle(data)
+			if reply is not None:
+				self.sock.sendto(reply, client)
+
+	def localPath(self, path):
+		return os.path.join(self.root, os.path.normpath("/" + path).lstrip("/"))
+
+	def handle(self, data):
+		if len(data) < 4:
+			return None
+		conn_id, sequence, command = ord(data[0]) | ord(data[1]) << 8, ord(data[2]), ord(data[3])
+		response = Responses[command]() if command in Responses else tnfs_client.Response().setCommand(command)
+		response.setSession(conn_id).setRetry(sequence).setReply(0)
+		if command == tnfs_client.Mount.TnfsCmd:
+			conn_id = self.next_session
+			self.next_session += 1
+			self.sessions[conn_id] = {"files": {}, "dirs": {}, "last": None}
+			return response.setSession(conn_id).setVersion((1, 2)).setRetryDelay(1000).toWire()
+		session = self.sessions.get(conn_id)
+		if session is None:
+			return response.setReply(EBADSESSION).toWire()
+		if session["last"] is not None and session["last"][:2] == (sequence, command):
+			return session["last"][2]
+
+		try:
+			message = Commands[command]().fromWire(data)
+			getattr(self, "do_" + message.__class__.__name__)(session, message, response)
+		except (KeyError, AttributeError):
+			response.setReply(errno.ENOSYS)
+		except ProtocolError:
+			response.setReply(errno.EINVAL)
+		except (OSError, IOError), e:
+			response.setReply(e.errno)
+		reply = response.toWire()
+		session["last"] = (sequence, command, reply)
+		return reply
+
+	def _handle(self, table, message_handle):
+		if message_handle not in table:
+			raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+		return table[message_handle]
+
+	def _free(self, table):
+		handle = 0
+		while handle in table:
+			handle += 1
+		if handle > 255:
+			raise OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+		return handle
+
+	def do_Umount(self, session, message, response):
+		for fd in session["files"].values():
+			os.close(fd)
+		del self.sessions[message.conn_id]
+
+	def do_OpenDir(self, session, message, response):
+		names = os.listdir(self.localPath(message.path))
+		handle = self._free(session["dirs"])
+		session["dirs"][handle] = [names, 0]
+		response.setHandle(handle)
+
+	def do_ReadDir(self, session, message, response):
+		listing = self._handle(session["dirs"], message.handle)
+		if listing[1] >= len(listing[0]):
+			raise OSError(TnfsEOF, "End of directory")
+		response.setPath(listing[0][listing[1]])
+		listing[1] += 1
+
+	def do_SeekDir(self, session, message, response):
+		self._handle(session["dirs"], message.handle)[1] = message.position
+
+	def do_TellDir(self, session, message, response):
+		response.setPosition(self._handle(session["dirs"], message.handle)[1])
+
+	def do_CloseDir(self, session, message, response):
+		self._handle(session["dirs"], message.handle)
+		del session["dirs"][message.handle]
+
+	def do_MkDir(self, session, message, response):
+		os.mkdir(self.localPath(message.path))
+
+	def do_RmDir(self, session, message, response):
+		os.rmdir(self.localPath(message.path))
+
+	def do_Open(self, session, message, response):
+		flags = {tnfs_flag.O_WRONLY: os.O_WRONLY, tnfs_flag.O_RDWR: os.O_RDWR}.get(message.flags & 0x03, os.O_RDONLY)
+		for tnfs, local in ((tnfs_flag.O_APPEND, os.O_APPEND), (tnfs_flag.O_CREAT, os.O_CREAT), (tnfs_flag.O_TRUNC, os.O_TRUNC), (tnfs_flag.O_EXCL, os.O_EXCL)):
+			if message.flags & tnfs:
+				flags |= local
+		handle = self._free(session["files"])
+		session["files"][handle] = os.open(self.localPath(message.path), flags, message.mode or 0644)
+		response.setFD(handle)
+
+	def do_Read(self, session, message, response):
+		data = os.read(self._handle(session["files"], message.fd), min(message.size, self.max_payload))
+		if not data:
+			raise OSError(TnfsEOF, "End of file")
+		response.setSize(len(data)).setData(data)
+
+	def do_Write(self, session, message, response):
+		response.setSize(os.write(self._handle(session["files"], message.fd), message.data[:self.max_payload]))
+
+	def do_Close(self, session, message, response):
+		os.close(self._handle(session["files"], message.fd))
+		del session["files"][message.fd]
+
+	def do_Stat(self, session, message, response):
+		st = os.stat(self.localPath(message.path))
+		response.setMode(st.st_mode & 0xffff).setSize(st.st_size & 0xffffffff)
+		response.setAtime(int(st.st_atime)).setMtime(int(st.st_mtime)).setCtime(int(st.st_ctime))
+
+	def do_LSeek(self, session, message, response):
+		os.lseek(self._handle(session["files"], message.fd), message.seekposition, message.seektype)
+
+	def do_Unlink(self, session, message, response):
+		os.unlink(self.localPath(message.path))
+
+	def do_ChMod(self, session, message, response):
+		os.chmod(self.localPath(message.path), message.mode)
+
+	def do_Rename(self, session, message, response):
+		os.rename(self.localPath(message.source), self.localPath(message.destination))
+
+	def do_Size(self, session, message, response):
+		st = os.statvfs(self.root)
+		response.setSize(min(st.f_blocks * st.f_frsize >> 10, 0xffffffff))
+
+	def do_Free(self, session, message, response):
+		st = os.statvfs(self.root)
+		response.setFree(min(st.f_bavail * st.f_frsize >> 10, 0xffffffff))
+
+class LossyProxy(object):
+	"""Relays datagrams between clients and a server over a simulated bad link. Each datagram,
+	in either direction, can be lost, delayed by latency +/- jitter, sent twice, or held back
+	long enough for the ones behind it to overtake it. Every client gets its own socket towards
+	the server, so the server tells sessions apart by address as it would behind a NAT"""
+	def __init__(self, target, loss = 0.0, latency = 0.0, jitter = 0.0, duplicate = 0.0, reorder = 0.0, hold = 0.05, seed = None):
+		self.target = target
+		self.loss = loss
+		self.latency = latency
+		self.jitter = jitter
+		self.duplicate = duplicate
+		self.reorder = reorder
+		self.hold = hold
+		self.rng = random.Random(seed)
+		self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.front.bind(("127.0.0.1", 0))
+		self.address = self.front.getsockname()
+		self.upstream = {}
+		self.clients = {}
+		## Datagrams waiting for their delivery time: (due, order, socket, data, address)
+		self.queue = []
+		self.queued = 0
+		self.condition = threading.Condition()
+		self.counts = collections.Counter()
+		self.running = False
+		self.threads = []
+
+	def start(self):
+		self.running = True
+		for target, name in ((self.relay, "proxy-relay"), (self.deliver, "proxy-deliver")):
+			thread = threading.Thread(target = target, name = name)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+		return self
+
+	def stop(self):
+		self.running = False
+		with self.condition:
+			self.condition.notify()
+		for thread in self.threads:
+			thread.join()
+		for sock in [self.front] + self.upstream.values():
+			sock.close()
+
+	def _schedule(self, sock, data, address):
+		self.counts["datagrams"] += 1
+		if self.rng.random() < self.loss:
+			self.counts["lost"] += 1
+			return
+		copies = 1
+		if self.rng.random() < self.duplicate:
+			self.counts["duplicated"] += 1
+			copies = 2
+		now = time.time()
+		with self.condition:
+			for copy in range(copies):
+				delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+				if self.rng.random() < self.reorder:
+					self.counts["held_back"] += 1
+					delay += self.hold
+				heapq.heappush(self.queue, (now + delay, self.queued, sock, data, address))
+				self.queued += 1
+			self.condition.notify()
+
+	def relay(self):
+		while self.running:
+			readable = select.select([self.front] + self.upstream.values(), [], [], 0.1)[0]
+			for sock in readable:
+				data, address = sock.recvfrom(65536)
+				if sock is self.front:
+					if address not in self.upstream:
+						upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+						upstream.bind(("127.0.0.1", 0))
+						self.upstream[address] = upstream
+						self.clients[upstream] = address
+					self._schedule(self.upstream[address], data, self.target)
+				else:
+					self._schedule(self.front, data, self.clients[sock])
+
+	def deliver(self):
+		with self.condition:
+			while self.running:
+				if not self.queue:
+					self.condition.wait(0.1)
+					continue
+				due = self.queue[0][0]
+				now = time.time()
+				if due > now:
+					self.condition.wait(due - now)
+					continue
+				_, _, sock, data, address = heapq.heappop(self.queue)
+				try:
+					sock.sendto(data, address)
+				except socket.error:
+					self.counts["send_errors"] += 1
+
+## Link conditions the soak runs through, by name
+Scenarios = collections.OrderedDict([
+	("clean", {}),
+	("loss", {"loss": 0.05}),
+	("latency", {"latency": 0.01, "jitter": 0.005}),
+	("duplication", {"duplicate": 0.1}),
+	("reordering", {"reorder": 0.1, "jitter": 0.002}),
+	("hostile", {"loss": 0.03, "latency": 0.002, "jitter": 0.002, "duplicate": 0.05, "reorder": 0.05}),
+])
+
+## Scenarios only run when named. With both duplication and holding back, a copy of a request can
+## reach the server after the client has moved on to the next one. tnfsd, like the stand-in, only
+## keeps the last reply of a session, so it carries the old request out again: a Write lands twice
+## or a Read or ReadDir moves the position on. The client never sees a reply for it and can't
+## tell, so these scenarios measure how often a link like that corrupts data rather than pass
+Explicit = ("hostile",)
+
+def loadFilesystem():
+	"""tnfs-fuse.py can't be imported by name. It needs fuse-python, though nothing gets mounted"""
+	return imp.load_source("tnfs_fuse", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tnfs-fuse.py"))
+
+@contextlib.contextmanager
+def quiet(enabled = True):
+	"""The filesystem prints every call it gets, which would drown the report"""
+	saved = sys.stdout
+	if enabled:
+		sys.stdout = open(os.devnull, "w")
+	try:
+		yield
+	finally:
+		if enabled:
+			sys.stdout.close()
+			sys.stdout = saved
+
+class Workload(object):
+	"""One thread of file system calls made the way the kernel would make them: through the
+	TNFS and TNFS_File objects of a mount. What it reads is checked against the shared
+	directory on disk, which the stand-in server serves"""
+	ChunkSize = 4096
+
+	def __init__(self, fusefs, fs, root, seeded, number, deadline, seed):
+		self.fusefs = fusefs
+		self.fs = fs
+		self.root = root
+		self.seeded = seeded
+		self.directory = "/work/%d" % number
+		self.deadline = deadline
+		self.rng = random.Random(seed)
+		self.written = {}
+		self.counts = collections.Counter()
+		self.failures = []
+
+	def fail(self, operation, description):
+		self.counts["failures"] += 1
+		self.failures.append("%s %s" % (operation, description))
+
+	def openFile(self, path, flags, *mode):
+		return self.fusefs.TNFS_File(path, flags, *mode)
+
+	def readRange(self, handle, offset, length):
+		data = ""
+		while len(data) < length:
+			chunk = handle.read(min(self.ChunkSize, length - len(data)), offset + len(data))
+			if not chunk:
+				break
+			data += chunk
+		self.counts["bytes_read"] += len(data)
+		return data
+
+	def read(self):
+		path = self.rng.choice(sorted(self.seeded))
+		expected = self.seeded[path]
+		offset = self.rng.randint(0, len(expected))
+		length = self.rng.randint(1, 4 * self.ChunkSize)
+		handle = self.openFile(path, os.O_RDONLY)
+		try:
+			data = self.readRange(handle, offset, length)
+		finally:
+			handle.release(path)
+		if data != expected[offset:offset + length]:
+			self.fail("read", "%s at %d+%d: got %d bytes, %d differ" % (path, offset, length, len(data), sum(a != b for a, b in zip(data, expected[offset:]))))
+
+	def write(self):
+		path = "%s/%d" % (self.directory, self.rng.randint(0, 15))
+		data = os.urandom(self.rng.randint(0, 6 * self.ChunkSize))
+		handle = self.openFile(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0644)
+		try:
+			for offset in range(0, len(data), self.ChunkSize):
+				written = handle.write(data[offset:offset + self.ChunkSize], offset)
+				self.counts["bytes_written"] += written
+				if written != len(data[offset:offset + self.ChunkSize]):
+					self.fail("write", "%s at %d: short write of %d bytes" % (path, offset, written))
+		finally:
+			handle.release(path)
+		self.written[path] = data
+		with open(os.path.join(self.root, path.lstrip("/")), "rb") as f:
+			if f.read() != data:
+				self.fail("write", "%s: the server's copy differs from what was written" % path)
+		handle = self.openFile(path, os.O_RDONLY)
+		try:
+			if self.readRange(handle, 0, len(data) + 1) != data:
+				self.fail("write", "%s: reading it back gave different data" % path)
+		finally:
+			handle.release(path)
+
+	def remove(self):
+		if not self.written:
+			return
+		path = self.rng.choice(sorted(self.written))
+		reply = self.fs.unlink(path)
+		if reply != 0:
+			self.fail("unlink", "%s: %s" % (path, os.strerror(-reply)))
+		del self.written[path]
+		if self.fs.getattr(path) != -errno.ENOENT:
+			self.fail("unlink", "%s is still there" % path)
+
+	def browse(self):
+		path = self.rng.choice(["/seed", self.directory])
+		names = sorted(entry.name for entry in self.fs.readdir(path, 0))
+		self.counts["entries"] += len(names)
+		local = os.path.join(self.root, path.lstrip("/"))
+		if names != sorted(os.listdir(local)):
+			self.fail("readdir", "%s: listed %d names, the server has %d" % (path, len(names), len(os.listdir(local))))
+		for name in names:
+			st = self.fs.getattr(path + "/" + name)
+			if isinstance(st, int):
+				self.fail("getattr", "%s/%s: %s" % (path, name, os.strerror(-st)))
+			elif st.st_size != os.stat(os.path.join(local, name)).st_size:
+				self.fail("getattr", "%s/%s: size %d, the server has %d" % (path, name, st.st_size, os.stat(os.path.join(local, name)).st_size))
+
+	def run(self):
+		operations = [self.read] * 4 + [self.write] * 2 + [self.browse] * 2 + [self.remove]
+		while time.time() < self.deadline:
+			operation = self.rng.choice(operations)
+			try:
+				operation()
+			except (IOError, OSError, socket.error), e:
+				self.fail(operation.__name__, "raised %r" % e)
+			self.counts["operations"] += 1
+
+def seedTree(root, rng, files = 32, largest = 64 << 10):
+	"""Fills root/seed with files of random sizes and contents, and returns them by path"""
+	seeded = {}
+	os.mkdir(os.path.join(root, "seed"))
+	os.mkdir(os.path.join(root, "work"))
+	for number in range(files):
+		data = "".join(chr(rng.randint(0, 255)) for _ in range(rng.randint(0, largest)))
+		with open(os.path.join(root, "seed", "%02d.bin" % number), "wb") as f:
+			f.write(data)
+		seeded["/seed/%02d.bin" % number] = data
+	return seeded
+
+def Soak(fusefs, name, conditions, duration = 10.0, workers = 8, seed = 0, max_payload = 512, verbose = False):
+	"""Mounts a stand-in server through a lossy proxy, runs workers concurrent workloads on it
+	for duration seconds and returns a dict of what happened"""
+	rng = random.Random(seed)
+	root = tempfile.mkdtemp(prefix = "tnfs-soak-")
+	server = proxy = fs = None
+	try:
+		seeded = seedTree(root, rng)
+		for number in range(workers):
+			os.mkdir(os.path.join(root, "work", str(number)))
+		server = StandInServer(root, max_payload).start()
+		proxy = LossyProxy(server.address, seed = rng.random(), **conditions).start()
+		before = metrics.snapshot()
+		with quiet(not verbose):
+			fs = fusefs.TNFS()
+			fs.address = "%s:%d" % proxy.address
+			fs.index = "off"
+			fs.fsinit()
+			started = time.time()
+			loads = [Workload(fusefs, fs, root, seeded, number, started + duration, rng.random()) for number in range(workers)]
+			threads = [threading.Thread(target = load.run, name = "soak-%d" % number) for number, load in enumerate(loads)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			elapsed = time.time() - started
+			fs.fsdestroy()
+		after = metrics.snapshot()
+	finally:
+		if proxy is not None:
+			proxy.stop()
+		if server is not None:
+			server.stop()
+		shutil.rmtree(root)
+
+	counts = collections.Counter()
+	failures = []
+	for load in loads:
+		counts.update(load.counts)
+		failures.extend(load.failures)
+	counts.update(proxy.counts)
+	for key in ("retransmits", "pipeline.retransmits", "stale_replies"):
+		counts[key] = after.get(key, 0) - before.get(key, 0)
+	return {
+		"name": name,
+		"elapsed": elapsed,
+		"counts": counts,
+		"failures": failures,
+		"throughput": (counts["bytes_read"] + counts["bytes_written"]) / elapsed,
+	}
+
+def report(result):
+	counts = result["counts"]
+	print "%-12s %6d ops %8.1f ops/s %8.1f KiB/s  lost %d dup %d held %d  retransmits %d stale %d  failures %d" % (result["name"],
+		counts["operations"], counts["operations"] / result["elapsed"], result["throughput"] / 1024,
+		counts["lost"], counts["duplicated"], counts["held_back"],
+		counts["retransmits"] + counts["pipeline.retransmits"], counts["stale_replies"], counts["failures"])
+	for failure in result["failures"][:10]:
+		print "    %s" % failure
+	if len(result["failures"]) > 10:
+		print "    ... and %d more" % (len(result["failures"]) - 10)
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage = "%prog [options] [scenario ...]", description = "Runs concurrent file system workloads against a local stand-in TNFS server, through a proxy that loses, delays, duplicates and reorders datagrams, and checks every byte that comes back. Scenarios: " + ", ".join(Scenarios) + " (" + ", ".join(Explicit) + " only when named)")
+	parser.add_option("--duration", type = "float", default = 10.0, help = "Seconds to run each scenario for (default %default)")
+	parser.add_option("--workers", type = "int", default = 8, help = "Concurrent workloads (default %default)")
+	parser.add_option("--seed", type = "int", default = 0, help = "Seed for the data and the link's misbehaviour (default %default)")
+	parser.add_option("--max-payload", type = "int", default = 512, help = "Most bytes the stand-in server reads or writes per message (default %default)")
+	parser.add_option("--loss", type = "float", help = "Run a custom scenario losing this fraction of datagrams")
+	parser.add_option("--latency", type = "float", default = 0.0, help = "Seconds of one-way delay in the custom scenario")
+	parser.add_option("--jitter", type = "float", default = 0.0, help = "Seconds the delay of the custom scenario varies by")
+	parser.add_option("--duplicate", type = "float", default = 0.0, help = "Fraction of datagrams sent twice in the custom scenario")
+	parser.add_option("--reorder", type = "float", default = 0.0, help = "Fraction of datagrams held back in the custom scenario")
+	parser.add_option("--verbose", action = "store_true", default = False, help = "Show what the file system prints")
+	options, names = parser.parse_args()
+
+	if options.loss is not None or options.latency or options.jitter or options.duplicate or options.reorder:
+		Scenarios["custom"] = {"loss": options.loss or 0.0, "latency": options.latency, "jitter": options.jitter, "duplicate": options.duplicate, "reorder": options.reorder}
+		names = names or ["custom"]
+	for name in names:
+		if name not in Scenarios:
+			parser.error("unknown scenario %s" % name)
+
+	fusefs = loadFilesystem()
+	failed = False
+	for name in names or [name for name in Scenarios if name not in Explicit]:
+		result = Soak(fusefs, name, Scenarios[name], options.duration, options.workers, options.seed, options.max_payload, options.verbose)
+		report(result)
+		failed = failed or len(result["failures"]) > 0
+	sys.exit(1 if failed else 0)